@@ -5,16 +5,14 @@ import os
 import snap7
 import socket
 from collections import namedtuple
+from source.discovery import discover
 from source.rpc.rpc_client import XmlRpcProxyManager
 
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-IP_LIST = [
-    # "192.168.0.47",
-    # "192.168.0.48",
-    "192.168.0.49",
-    "192.168.0.50",
-]
+NETWORK = "192.168.0.0/24"
+# Sensors answering on the PCIC port of the subnet
+IP_LIST = [info['pcic_address'] for info in discover(NETWORK)]
 PLATFORM = "3.5.0061"
 Point = namedtuple("Point", ["x", "y"])
 
@@ -1,9 +1,16 @@
 import cv2
+import copy
+import time
 import numpy as np
 from io import BytesIO
 from source.o2d22x import O2D22xPCICDevice
+from source.retry import RetryPolicy, RetryExhausted
+from source.lazy_image import ImagePolicy
+from source.buffer_pool import BufferPool
+from source.calibration import LineCalibration
+from source.correlation import FrameCorrelator, parse_chunk_header
 import matplotlib.pyplot as plt
-from collections import namedtuple
+from collections import namedtuple, deque
 
 
 
@@ -73,14 +80,86 @@ class LineAnalyser():
         }
     }
 
-    def __init__(self, ip_list) -> None:
+    def __init__(self, ip_list, retry_policy=None, image_policy=None, calibration=None) -> None:
         self.cameras = [O2D22xPCICDevice(ip, 50010) for ip in ip_list]
+        self.data_struct = copy.deepcopy(LineAnalyser.data_struct)
+        # Retries per camera, set a budget (s) to bound the time spent on one camera
+        self.retry_policy = retry_policy or RetryPolicy(tries=3)
+        # Which images are kept, e.g. ImagePolicy('fail_only') or ImagePolicy('sampled', every=10)
+        self.image_policy = image_policy or ImagePolicy('always')
         # Area definition
         self.mx = 200
         self.my = 200
         self.or_err = 20
+        # Line tolerance (mm) of a camera's offset from the median offset of the line, see GAP
+        self.line_tol = 10.0
         self.img_w = 640
         self.img_h = 480
+        # Pixel -> mm, a calibration file path, a LineCalibration or 3 px/mm by default
+        if calibration is None:
+            calibration = LineCalibration.uniform(len(self.cameras), 3.0, self.img_w, self.img_h)
+        elif isinstance(calibration, str):
+            calibration = LineCalibration.load(calibration)
+        self.calibration = calibration
+        # Annotation
+        self.annotate = True
+        self._overlays = {}
+        # Optional source.archive.ArchiveWriter, keeps the raw JPEG of every kept image
+        self.archive = None
+        # Optional source.correlation.FrameCorrelator keyed by camera address, see correlate
+        self.correlator = None
+        # Optional source.status_server.StatusServer, receives every finished cycle
+        self.publisher = None
+        # Sensor counters (s?) published with the cycles, read at most every interval seconds
+        self.statistics_interval = 5.0
+        self._sensor_statistics = {}
+        # Cycles whose pooled images are released later, see use_buffer_pools
+        self._recycle = None
+        self._recycle_depth = 0
+
+    def use_buffer_pools(self, depth=2):
+        """
+        Receive and decode the images into pooled buffers instead of allocating them
+        on every cycle.
+
+        The receive buffers are reused as they are. The decoded frames are not decoded in
+        place: each image is still decoded into a temporary array first and copied into
+        its pooled frame (see O2D22xPCICDevice.decode_image), so a cycle allocates about
+        one frame per image instead of two.
+
+        The images of a cycle are released once `depth` newer cycles have been
+        published, consumers must not keep them longer (the status server stops
+        reading a cycle when the next one is published).
+        """
+        if depth < 1:
+            raise ValueError('<depth> should be greater than 0')
+        size = max(1, len(self.cameras)) * (depth + 1)
+        self.image_policy.frames = BufferPool.frames(size, (self.img_h, self.img_w, 3))
+        self.image_policy.receive = BufferPool.receive(size)
+        self._recycle = deque()
+        self._recycle_depth = depth
+
+    def correlate(self, takt, tolerance=None, timeout=None):
+        """
+        Group the results of the cameras into per-part snapshots (self.correlator).
+
+        The results are placed at the trigger time of their camera (or at their device
+        time when the image is a binary chunk, whose frame count is checked as well).
+        A camera that gave up is reported missing in its part, one whose retry landed
+        outside the window leaves its part incomplete, one whose frame count jumped is
+        flagged misaligned.
+
+        :param takt: seconds between two parts on the line
+        :param tolerance: seconds between the first and the last trigger of a part,
+                          a quarter takt by default so a result half a takt late can
+                          not be taken for one of the next part
+        :param timeout: seconds after which an incomplete part is emitted, 2 takts by default
+        :return: the FrameCorrelator, read the snapshots with its poll()
+        """
+        self.correlator = FrameCorrelator([cam.ip_address for cam in self.cameras],
+                                          takt / 4 if tolerance is None else tolerance,
+                                          2 * takt if timeout is None else timeout)
+        return self.correlator
 
     def getAllInfo(self):
         all_info = []
@@ -89,94 +168,200 @@ class LineAnalyser():
         
         return all_info
     
-    def analize_cam(self, id_cam, app):
-        tries = 3
+    @staticmethod
+    def _classify_responses(responses):
+        kind = RetryPolicy.classify(responses)
+        if kind is None:
+            kind = RetryPolicy.classify(responses['RES_EVA'])
+        return kind
+
+    def _evaluate_cam(self, cam, app):
         responses = {}
-        cam = self.cameras[id_cam]
-        while tries:
-            responses['SET_APP'] = cam.select_application(app)      # * !
-            responses['SET_OT1'] = cam.activate_result_output(1)    # * !
-            responses['RES_EVA'] = cam.evaluate_image_decoded()     # data !
-            print(responses)
-            if responses['RES_EVA']['result'] == "0FAIL":
-                print(f'<CAM{id_cam}> Evaluation fail - T{3-tries} retring')
-                tries -= 1
-                continue
-            responses['SET_OT2'] = cam.activate_result_output(0)    # * !    
-            responses['RES_IMG'] = cam.request_image_decoded(responses['RES_EVA']['result'])     # data !
-
-            for key, value in responses.items():
-                if str(value) == '!':
-                    print(f'<CAM{id_cam}> Fail {key} - T{3-tries}')                    
-                    tries -= 1
-                    continue
-                
-            return (responses['RES_EVA'], responses['RES_IMG'])
-        
-        responses['RES_EVA'] = {'result': 'FAIL'}
-        responses['RES_IMG'] = cam.request_image_decoded(responses['RES_EVA']['result'])     # data !
-        return (responses['RES_EVA'], responses['RES_IMG'])
+        responses['SET_APP'] = cam.ensure_application(app)      # * !
+        responses['SET_OT1'] = cam.activate_result_output(1)    # * !
+        responses['RES_EVA'] = cam.evaluate_image_decoded()     # data !
+        print(responses)
+        if self._classify_responses(responses) is not None:
+            return responses
+        responses['SET_OT2'] = cam.activate_result_output(0)    # * !
+        return responses
 
-
-    def run_analizer(self):
+    def analize_cam(self, id_cam, app):
+        cam = self.cameras[id_cam]
+        try:
+            responses = self.retry_policy.run(cam.ip_address, self._evaluate_cam, cam, app,
+                                              classify=self._classify_responses)
+            res_eva = responses['RES_EVA']
+            if isinstance(res_eva, dict):
+                res_eva['trigger_ts'] = cam.trigger_ts
+            return (res_eva, self.image_policy.handle(cam, res_eva['result']))
+        except RetryExhausted as e:
+            stats = self.retry_policy.get_stats(cam.ip_address)
+            print(f'<CAM{id_cam}> Evaluation {e.kind} - giving up ({stats["attempts"]} attempts)')
+
+        res_eva = {'result': 'FAIL', 'trigger_ts': cam.trigger_ts, 'error': 1}
+        return (res_eva, self.image_policy.handle(cam, res_eva['result']))
+
+    def _correlate(self, id_cam, result):
+        res_eva, image = result
+        if res_eva.get('error'):
+            # No evaluation, the camera stays missing in its part
+            return
+        # Frame count and device time when the image came as a binary chunk
+        header = parse_chunk_header(memoryview(image.raw)[9:]) if image.fetched else None
+        self.correlator.add(self.cameras[id_cam].ip_address, res_eva, res_eva['trigger_ts'],
+                            frame_count=header['FRAME_COUNT'] if header else None,
+                            device_time=header['DEVICE_TIME'] if header else None)
+
+    def _static_overlay(self, id_cam, shape):
+        """
+        Return the (flat indices, rows, columns, colours) of the pixels of the margin lines and crosshair for a camera.
+
+        The layer only depends on the image size and the tolerances, so it is rendered
+        once per camera and configuration and only its pixels are written on every cycle.
+        """
+        key = (id_cam, shape, self.img_w, self.img_h, self.mx, self.my)
+        cached = self._overlays.get(key)
+        if cached is not None:
+            return cached
+
+        overlay = np.zeros(shape, dtype=np.uint8)
+        # Margin lines
+        lx_1s = (int(self.img_w/2 - self.mx), self.img_h)
+        lx_1e = (int(self.img_w/2 - self.mx), 0)
+        lx_2s = (int(self.img_w/2 + self.mx), self.img_h)
+        lx_2e = (int(self.img_w/2 + self.mx), 0)
+
+        ly_1s = (self.img_w, int(self.img_h/2 - self.my))
+        ly_1e = (0, int(self.img_h/2 - self.my))
+        ly_2s = (self.img_w, int(self.img_h/2 + self.my))
+        ly_2e = (0, int(self.img_h/2 + self.my))
+
+        cv2.line(overlay, lx_1s, lx_1e, (0, 255, 0), 1)
+        cv2.line(overlay, lx_2s, lx_2e, (0, 255, 0), 1)
+        cv2.line(overlay, ly_1s, ly_1e, (0, 255, 0), 1)
+        cv2.line(overlay, ly_2s, ly_2e, (0, 255, 0), 1)
+
+        # Crosshair
+        ch_s = (0, int(self.img_h/2))
+        ch_e = (self.img_w, int(self.img_h/2))
+        cv_s = (int(self.img_w/2), 0)
+        cv_e = (int(self.img_w/2), self.img_h)
+        cv2.line(overlay, ch_s, ch_e, (150, 0, 150), 1)
+        cv2.line(overlay, cv_s, cv_e, (150, 0, 150), 1)
+
+        ys, xs = np.nonzero(overlay.any(axis=2))
+        cached = (ys * shape[1] + xs, ys, xs, overlay[ys, xs])
+        self._overlays[key] = cached
+        return cached
+
+    def annotate_image(self, id_cam, img, obj, dx, dy):
+        """
+        Write the static overlay pixels into the image and draw the per-object offsets in place.
+        """
+        idx, ys, xs, colours = self._static_overlay(id_cam, img.shape)
+        if img.flags.c_contiguous:
+            img.reshape(-1, img.shape[2])[idx] = colours
+        else:
+            img[ys, xs] = colours
+        cv2.circle(img, (obj.x, obj.y), 0, (255, 0, 0), 5)
+
+        # Draw difference
+        ldx_s = (obj.x, obj.y)
+        ldx_e = (int(self.img_w/2), obj.y)
+        ldy_s = (obj.x, obj.y)
+        ldy_e = (obj.x, int(self.img_h/2))
+        cv2.line(img, ldx_s, ldx_e, (150, 0, 150), 1)
+        cv2.line(img, ldy_s, ldy_e, (150, 0, 150), 1)
+        txt_dx = (int((obj.x + self.img_w/2)/2), obj.y + 10)
+        txt_dy = (obj.x+10, int((obj.y + self.img_h/2)/2))
+        cv2.putText(img, f"x_diff: {dx}", (txt_dx), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (150, 0, 150), 1)
+        cv2.putText(img, f"y_diff: {dy}", (txt_dy), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (150, 0, 150), 1)
+        return img
+
+    def run_analizer(self, annotate=None):
+        """
+        Evaluate every camera and compute the offsets of the detected objects.
+
+        :param annotate: draw the analysis on the images. Defaults to self.annotate,
+                         set it to False when no consumer needs annotated frames.
+        :return: list of (result, LazyImage) tuples, one per camera. The images are
+                 only transferred when accessed (or annotated), see self.image_policy.
+                 With self.correlator set (see correlate), the per-part snapshots
+                 are read with self.correlator.poll()
+        """
+        if annotate is None:
+            annotate = self.annotate
+        self.data_struct['SYSTEM']['BUSY'] = 1
+        self.data_struct['SYSTEM']['READY'] = 0
         results = []
         for i in range(len(self.cameras)):
             result = self.analize_cam(i, 1)
             print(result[0])
             results.append(result)
-
-        for cam_response in results:
-            if cam_response[0]['result'] == 'FAIL':
+            if self.correlator is not None:
+                self._correlate(i, result)
+            if self.archive is not None and result[1].enabled:
+                self.archive.append_answer(self.cameras[i].ip_address, result[0]['result'], result[1].raw)
+
+        # Offsets and tolerances of all the cameras at once
+        classified = self.calibration.classify([r[0] for r in results], self.mx, self.my, self.or_err,
+                                                  self.line_tol)
+        self.calibration.fill(self.data_struct, classified)
+        offsets_px = classified['offset_px'].tolist()
+        offsets_mm = classified['offset'].tolist()
+        fails = classified['fail'].tolist()
+
+        for id_cam, cam_response in enumerate(results):
+            if fails[id_cam]:
                 continue
             obj = Objeto(cam_response[0]['x'], cam_response[0]['y'], cam_response[0]['rot'])
-            img = cam_response[1]
-            # Print analysis on image
-            dx = self.img_w/2 - obj.x
-            dy = self.img_h/2 - obj.y
+            dx, dy = offsets_px[id_cam]
             cam_response[0]['dx'] = dx
             cam_response[0]['dy'] = dy
-            
-            # Draw margin lines
-            lx_1s = (int(self.img_w/2 - self.mx), self.img_h)
-            lx_1e = (int(self.img_w/2 - self.mx), 0)
-            lx_2s = (int(self.img_w/2 + self.mx), self.img_h)
-            lx_2e = (int(self.img_w/2 + self.mx), 0)
-
-            ly_1s = (self.img_w, int(self.img_h/2 - self.my))
-            ly_1e = (0, int(self.img_h/2 - self.my))
-            ly_2s = (self.img_w, int(self.img_h/2 + self.my))
-            ly_2e = (0, int(self.img_h/2 + self.my))
-
-            ch_s = (0, int(self.img_h/2))
-            ch_e = (self.img_w, int(self.img_h/2))
-            cv_s = (int(self.img_w/2), 0)
-            cv_e = (int(self.img_w/2), self.img_h)
-
-            cv2.line(img, lx_1s, lx_1e, (0, 255, 0), 1)
-            cv2.line(img, lx_2s, lx_2e, (0, 255, 0), 1)
-            cv2.line(img, ly_1s, ly_1e, (0, 255, 0), 1)
-            cv2.line(img, ly_2s, ly_2e, (0, 255, 0), 1)
-            cv2.circle(img, (obj.x, obj.y), 0, (255, 0, 0), 5)
-            
-            cv2.line(img, ch_s, ch_e, (150, 0, 150), 1)
-            cv2.line(img, cv_s, cv_e, (150, 0, 150), 1)
-
-            # Draw difference
-            ldx_s = (obj.x, obj.y)
-            ldx_e = (int(self.img_w/2), obj.y)
-            ldy_s = (obj.x, obj.y)
-            ldy_e = (obj.x, int(self.img_h/2))
-            cv2.line(img, ldx_s, ldx_e, (150, 0, 150), 1)
-            cv2.line(img, ldy_s, ldy_e, (150, 0, 150), 1)
-            txt_dx = (int((obj.x + self.img_w/2)/2), obj.y + 10)
-            txt_dy = (obj.x+10, int((obj.y + self.img_h/2)/2))
-            cv2.putText(img, f"x_diff: {dx}", (txt_dx), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (150, 0, 150), 1)
-            cv2.putText(img, f"y_diff: {dy}", (txt_dy), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (150, 0, 150), 1)
-
-            cam_response = (cam_response[0], img)
+            cam_response[0]['dx_mm'], cam_response[0]['dy_mm'] = offsets_mm[id_cam]
 
+            # Print analysis on image
+            if annotate:
+                img = cam_response[1].image
+                if img is not None:
+                    self.annotate_image(id_cam, img, obj, dx, dy)
+
+        self.data_struct['SYSTEM']['BUSY'] = 0
+        self.data_struct['SYSTEM']['READY'] = 1
+        if self.publisher is not None:
+            self.publisher.publish(results, self.data_struct, {'retries': self.retry_policy.stats,
+                                                               'sensors': self.sensor_statistics()})
+        if self._recycle is not None:
+            self._recycle.append(results)
+            while len(self._recycle) > self._recycle_depth:
+                for _, handle in self._recycle.popleft():
+                    handle.release()
         return results
 
+    def sensor_statistics(self):
+        """
+        Evaluation counters of the sensors (s?). A camera is asked again only after
+        self.statistics_interval seconds, the cached counters are returned otherwise.
+
+        :return: {camera address: {'total', 'good', 'bad', 'timestamp'} or None}
+        """
+        now = time.monotonic()
+        for cam in self.cameras:
+            polled, _ = self._sensor_statistics.get(cam.ip_address, (None, None))
+            if polled is not None and now - polled < self.statistics_interval:
+                continue
+            try:
+                counters = cam.request_statistics().split()
+                entry = dict(zip(('total', 'good', 'bad'), map(int, counters)), timestamp=time.time())
+                if len(counters) != 3:
+                    entry = None
+            except (OSError, ValueError) as e:
+                print(f'<{cam.ip_address}> Statistics not available: {e}')
+                entry = None
+            self._sensor_statistics[cam.ip_address] = (now, entry)
+        return {ip: entry for ip, (_, entry) in self._sensor_statistics.items()}
+
             
 
         
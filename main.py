@@ -1,23 +1,20 @@
 import threading
 import matplotlib.pyplot as plt
 from line_analizer import LineAnalyser
+from source.discovery import discover
 
 
 
-IP_LIST = [
-    # "192.168.1.110",
-    # "10.5.0.55",
-    "192.168.0.50",
-    # "192.168.0.49",
-    # "192.168.0.50",
-]
+NETWORK = "192.168.0.0/24"
+# Sensors answering on the PCIC port of the subnet
+IP_LIST = [info['pcic_address'] for info in discover(NETWORK)]
 
 analisis = LineAnalyser(IP_LIST)
 
 def main():
     info = analisis.run_analizer()
     for i in info:
-        img = i[1]
+        img = i[1].image
         for key, value in i[0].items():
             print(f'{key}: \t{value}')
         plt.imshow(img)
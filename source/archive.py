@@ -0,0 +1,226 @@
+import glob
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
+
+
+# Fixed size index record: camera, timestamp (epoch s), result, blob offset, image length
+RECORD = struct.Struct('<16sd8sQI4x')
+ArchiveRecord = namedtuple('ArchiveRecord', ['camera', 'timestamp', 'result', 'offset', 'length', 'jpeg'])
+
+
+def segment_paths(path, segment):
+    """
+    Return the (blob, index) file names of a segment of the archive `path`.
+    """
+    return f"{path}.{segment:04d}.blob", f"{path}.{segment:04d}.idx"
+
+
+def list_segments(path):
+    """
+    Return the segment numbers of the archive `path` in order.
+    """
+    pattern = re.compile(re.escape(path) + r'\.(\d{4})\.idx$')
+    segments = []
+    for name in glob.glob(glob.escape(path) + '.*.idx'):
+        match = pattern.match(name)
+        if match:
+            segments.append(int(match.group(1)))
+    return sorted(segments)
+
+
+class ArchiveWriter(object):
+    """
+    Append-only archive of evaluation images.
+
+    The JPEG bytes sent by the device are stored as they are in a blob file and a
+    fixed size record (see RECORD) is appended to the index file for each image.
+    Writing happens on a background thread: `append` only queues the image and
+    never blocks the acquisition, images are dropped (and counted) if the queue is full.
+    A new segment is started when the blob file would grow over `max_bytes`.
+
+    Parameters
+    ----------
+    path:
+        base path of the archive, segments are written as <path>.NNNN.blob/.idx
+    max_bytes:
+        maximum size of one blob file.
+    queue_size:
+        images that can wait to be written.
+    opener:
+        function (path, mode) -> file used to open the segment files, `open` by default.
+    """
+    def __init__(self, path, max_bytes=1 << 30, queue_size=256, opener=open) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.opener = opener
+        self.dropped = 0
+        self.written = 0
+        # Exception that stopped the writer thread (e.g. disk full), None while writing
+        self.error = None
+        segments = list_segments(path)
+        self.segment = segments[-1] + 1 if segments else 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, camera, result, jpeg, timestamp=None):
+        """
+        Queue an image for writing.
+
+        :param camera: camera identifier, up to 16 characters (e.g. the ip address)
+        :param result: evaluation result, up to 8 characters
+        :param jpeg: image bytes as sent by the device
+        :return: False if the image was dropped
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self._queue.put_nowait((str(camera), str(result), jpeg, timestamp))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def append_answer(self, camera, result, trama, timestamp=None):
+        """
+        Queue the answer of request_last_image/request_last_bad_img (<length><image data>).
+
+        :return: False if the device rejected the request or the image was dropped
+        """
+        if trama is None or trama == b'!':
+            return False
+        length = int(bytes(trama[:9]))
+        # Copy, the answer buffer may be reused by the caller
+        jpeg = bytes(memoryview(trama)[9:9 + length])
+        return self.append(camera, result, jpeg, timestamp)
+
+    def close(self):
+        """
+        Write the queued images and close the files.
+        """
+        # The writer may have died with a full queue, never wait for it blindly
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self._thread.join()
+
+    def _open_segment(self):
+        blob_path, idx_path = segment_paths(self.path, self.segment)
+        return self.opener(blob_path, 'ab'), self.opener(idx_path, 'ab')
+
+    def _write(self):
+        blob = idx = None
+        try:
+            blob, idx = self._open_segment()
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                camera, result, jpeg, timestamp = item
+                offset = blob.tell()
+                if offset and offset + len(jpeg) > self.max_bytes:
+                    blob.close()
+                    idx.close()
+                    self.segment += 1
+                    blob, idx = self._open_segment()
+                    offset = 0
+                blob.write(jpeg)
+                idx.write(RECORD.pack(camera.encode()[:16], timestamp, result.encode()[:8], offset, len(jpeg)))
+                self.written += 1
+                if self._queue.empty():
+                    # Blob first, an index record never points to missing data
+                    blob.flush()
+                    idx.flush()
+        except Exception as e:
+            self.error = e
+            print(f"<archive {self.path}> Writer stopped: {e!r}")
+        finally:
+            for file in (blob, idx):
+                if file is not None:
+                    file.close()
+
+
+class ArchiveReader(object):
+    """
+    Random access reader of one archive segment through mmap.
+
+    reader[i] returns an ArchiveRecord, its jpeg field is a memoryview into the
+    mapped blob file (no copy). Only records written before opening are visible.
+    """
+    def __init__(self, path, segment=0) -> None:
+        blob_path, idx_path = segment_paths(path, segment)
+        self._blob_file = open(blob_path, 'rb')
+        self._idx_file = open(idx_path, 'rb')
+        self._blob = self._map(self._blob_file)
+        self._idx = self._map(self._idx_file)
+        self._count = len(self._idx) // RECORD.size if self._idx is not None else 0
+
+    @staticmethod
+    def _map(file):
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def replay(cls, path):
+        """
+        Iterate over the records of every segment of the archive in order.
+        """
+        for segment in list_segments(path):
+            reader = cls(path, segment)
+            try:
+                yield from reader
+            finally:
+                reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('archive record out of range')
+        camera, timestamp, result, offset, length = RECORD.unpack_from(self._idx, index * RECORD.size)
+        jpeg = memoryview(self._blob)[offset:offset + length]
+        return ArchiveRecord(camera.rstrip(b'\0').decode(), timestamp, result.rstrip(b'\0').decode(),
+                             offset, length, jpeg)
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
+    def close(self):
+        """
+        Close the files, mappings still referenced by records are released with them.
+        """
+        for mapped in (self._blob, self._idx):
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    # A record still references the mapping, it is released with it
+                    pass
+        self._blob_file.close()
+        self._idx_file.close()
@@ -0,0 +1,374 @@
+"""
+Benchmark of the PCIC and XML-RPC paths, results are written as JSON.
+
+    python -m source.bench --pcic 192.168.0.50 --rpc 192.168.0.49 --cycles 200
+    python -m source.bench --emulate 2 --output bench.json
+    python -m source.bench --emulate 1 --tracemalloc
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import xmlrpc.client
+import numpy as np
+from .buffer_pool import BufferPool
+from .o2d22x import O2D22xPCICDevice, decode_result
+
+
+STAGES = ('network', 'parse', 'decode', 'annotate')
+
+
+def split_target(target, default_port):
+    """
+    "ip" or "ip:port" -> (ip, port)
+    """
+    host, _, port = target.partition(':')
+    return host, int(port) if port else default_port
+
+
+def latency_summary(samples):
+    """
+    Summary in milliseconds of a list of durations in seconds.
+    """
+    if not samples:
+        return None
+    ms = np.asarray(samples) * 1000.0
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {'mean': float(ms.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+            'max': float(ms.max())}
+
+
+class _Stage(object):
+    """
+    Accumulates wall and thread CPU time of one stage.
+    """
+    def __init__(self) -> None:
+        self.wall = 0.0
+        self.cpu = 0.0
+
+    @contextlib.contextmanager
+    def measure(self):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.wall += time.perf_counter() - wall
+            self.cpu += time.thread_time() - cpu
+
+
+def bench_pcic(host, port, cycles, warmup=5, annotate=True):
+    """
+    Run T? + R? + I? + decode (+ annotation) cycles against one PCIC device.
+
+    cpu_ms_per_cycle is the CPU time of the benchmark thread (time.thread_time), so
+    emulators running in the same process are not counted.
+    """
+    device = O2D22xPCICDevice(host, port)
+    analyser = None
+    if annotate:
+        from line_analizer import LineAnalyser, Objeto
+        analyser = LineAnalyser([])
+
+    stages = {stage: _Stage() for stage in STAGES}
+    latencies = []
+    failed = 0
+    start_bytes = device.recv_counter
+    start_cpu = time.thread_time()
+    start = time.perf_counter()
+    for cycle in range(warmup + cycles):
+        if cycle == warmup:
+            stages = {stage: _Stage() for stage in STAGES}
+            latencies = []
+            failed = 0
+            start_bytes = device.recv_counter
+            start_cpu = time.thread_time()
+            start = time.perf_counter()
+        cycle_start = time.perf_counter()
+        with stages['network'].measure():
+            trama = device.evaluate_image()
+        with stages['parse'].measure():
+            evaluation = decode_result(trama)
+        with stages['network'].measure():
+            last = device.request_last_result()
+        with stages['parse'].measure():
+            decode_result(last)
+        if evaluation == '!':
+            failed += 1
+            latencies.append(time.perf_counter() - cycle_start)
+            continue
+        with stages['network'].measure():
+            raw = device.request_image(evaluation['result'])
+        with stages['decode'].measure():
+            img = device.decode_image(raw)
+        if analyser is not None and evaluation['x'] is not None and not isinstance(img, str):
+            with stages['annotate'].measure():
+                obj = Objeto(evaluation['x'], evaluation['y'], evaluation['rot'])
+                analyser.annotate_image(0, img, obj, analyser.img_w/2 - obj.x, analyser.img_h/2 - obj.y)
+        latencies.append(time.perf_counter() - cycle_start)
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu
+    received = device.recv_counter - start_bytes
+    device.close()
+
+    return {
+        'cycles': cycles,
+        'failed': failed,
+        'throughput_per_s': cycles / elapsed if elapsed else None,
+        'latency_ms': latency_summary(latencies),
+        'bytes_per_cycle': received / cycles if cycles else None,
+        'cpu_ms_per_cycle': cpu * 1000.0 / cycles if cycles else None,
+        'stages': {name: {'wall_ms_per_cycle': stage.wall * 1000.0 / cycles,
+                          'cpu_ms_per_cycle': stage.cpu * 1000.0 / cycles}
+                   for name, stage in stages.items()} if cycles else None,
+    }
+
+
+def bench_alloc(host, port, cycles, warmup=5, pooled=True):
+    """
+    Python heap allocated by the image path of the line (LazyImage: I? + decode),
+    measured with tracemalloc, with or without buffer pools.
+
+    allocated_bytes_per_cycle is the memory a cycle allocates on top of what it
+    started with (the tracemalloc peak, a lower bound of everything it allocates),
+    retained_bytes_per_cycle what is still allocated after it.
+
+    cv2.imdecode can not decode into a given array, so even with the pools every
+    cycle allocates the decoded frame once (~0.92 MB for 640x480 BGR) before it is
+    copied into the pooled one: about half of the unpooled cycle, not zero.
+    """
+    from .lazy_image import ImagePolicy
+    device = O2D22xPCICDevice(host, port)
+    if pooled:
+        policy = ImagePolicy('always', frames=BufferPool.frames(1), receive=BufferPool.receive(1))
+    else:
+        policy = ImagePolicy('always')
+
+    def cycle():
+        handle = policy.handle(device, 'PASS')
+        handle.image
+        handle.release()
+
+    for _ in range(warmup):
+        cycle()
+    tracemalloc.start()
+    try:
+        retained = []
+        allocated = []
+        for _ in range(cycles):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            cycle()
+            current, top = tracemalloc.get_traced_memory()
+            retained.append(current - before)
+            allocated.append(top - before)
+    finally:
+        tracemalloc.stop()
+        device.close()
+
+    return {
+        'pooled': pooled,
+        'cycles': cycles,
+        'allocated_bytes_per_cycle': float(np.mean(allocated)) if cycles else None,
+        'max_allocated_bytes': int(max(allocated)) if cycles else None,
+        'retained_bytes_per_cycle': float(np.mean(retained)) if cycles else None,
+    }
+
+
+RPC_STAGES = ('network', 'parse')
+
+
+class _MeasuredTransport(xmlrpc.client.Transport):
+    """
+    XML-RPC transport counting the bytes of the bodies and splitting every call into
+    network (request and answer transfer) and parse (unmarshalling) stages.
+    One transport per proxy, so each one is only used by one thread at a time.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.sent = 0
+        self.received = 0
+        self.stages = {stage: _Stage() for stage in RPC_STAGES}
+
+    def reset(self):
+        self.sent = 0
+        self.received = 0
+        self.stages = {stage: _Stage() for stage in RPC_STAGES}
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        self.sent += len(request_body)
+        with self.stages['network'].measure():
+            return super().single_request(host, handler, request_body, verbose)
+
+    def parse_response(self, response):
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            return super().parse_response(response)
+        data = response.read()
+        self.received += len(data)
+        # Runs inside single_request, moved from the network stage to the parse stage
+        network = self.stages['network']
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        parser, unmarshaller = self.getparser()
+        parser.feed(data)
+        parser.close()
+        result = unmarshaller.close()
+        wall = time.perf_counter() - wall
+        cpu = time.thread_time() - cpu
+        self.stages['parse'].wall += wall
+        self.stages['parse'].cpu += cpu
+        network.wall -= wall
+        network.cpu -= cpu
+        return result
+
+
+def _measured(func, stage):
+    """
+    func timed into stage, from whichever thread it is called.
+    """
+    def measured(*args, **kwargs):
+        with stage.measure():
+            return func(*args, **kwargs)
+    return measured
+
+
+def bench_rpc(hosts, port, cycles, warmup=2, platform_version="3.5.0061"):
+    """
+    Run XmlRpcProxyManager.execute_detection cycles over all the hosts at once.
+
+    bytes_per_cycle counts the XML bodies of all the cameras (HTTP headers excluded).
+    cpu_ms_per_cycle is the CPU time of the calling thread plus the one of the
+    detection threads (time.thread_time), emulators in the same process are not counted.
+    """
+    from .rpc.rpc_client import XmlRpcProxyManager
+    manager = XmlRpcProxyManager(hosts, port, platform_version)
+    transports = []
+    detections = []
+    for proxy in manager:
+        transport = _MeasuredTransport()
+        proxy.proxy = xmlrpc.client.ServerProxy(proxy.url, transport=transport)
+        transports.append(transport)
+        detection = _Stage()
+        proxy.execute_detection = _measured(proxy.execute_detection, detection)
+        detections.append(detection)
+    manager.connect()
+    manager.init_config()
+
+    latencies = []
+    errors = 0
+    for cycle in range(warmup + cycles):
+        if cycle == warmup:
+            latencies = []
+            errors = 0
+            for transport in transports:
+                transport.reset()
+            for detection in detections:
+                detection.cpu = 0.0
+            start_cpu = time.thread_time()
+            start = time.perf_counter()
+        cycle_start = time.perf_counter()
+        results = manager.execute_detection()
+        latencies.append(time.perf_counter() - cycle_start)
+        errors += sum(1 for result in results if result is None or result.get('error'))
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu + sum(detection.cpu for detection in detections)
+    for proxy in manager:
+        # Drop the wrapper, it keeps the proxy in a reference cycle
+        del proxy.execute_detection
+    manager.disconnect()
+
+    return {
+        'cameras': len(hosts),
+        'cycles': cycles,
+        'errors': errors,
+        'throughput_per_s': cycles / elapsed if elapsed else None,
+        'latency_ms': latency_summary(latencies),
+        'bytes_per_cycle': sum(t.received for t in transports) / cycles if cycles else None,
+        'sent_bytes_per_cycle': sum(t.sent for t in transports) / cycles if cycles else None,
+        'cpu_ms_per_cycle': cpu * 1000.0 / cycles if cycles else None,
+        # Summed over the cameras, the calls run in parallel threads
+        'stages': {name: {'wall_ms_per_cycle': sum(t.stages[name].wall for t in transports) * 1000.0 / cycles,
+                          'cpu_ms_per_cycle': sum(t.stages[name].cpu for t in transports) * 1000.0 / cycles}
+                   for name in RPC_STAGES} if cycles else None,
+        'retries': manager.retry_policy.stats,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m source.bench', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pcic', action='append', default=[], metavar='IP[:PORT]',
+                        help='PCIC device to benchmark, can be repeated')
+    parser.add_argument('--pcic-port', type=int, default=50010)
+    parser.add_argument('--rpc', action='append', default=[], metavar='IP',
+                        help='XML-RPC device to benchmark, can be repeated')
+    parser.add_argument('--rpc-port', type=int, default=8080)
+    parser.add_argument('--cycles', type=int, default=100)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--no-annotate', action='store_true', help='skip the annotation stage')
+    parser.add_argument('--emulate', type=int, default=0, metavar='N',
+                        help='start N loopback stand-in sensors (PCIC and XML-RPC) and benchmark them')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='measure the allocations of the image path, with and without buffer pool')
+    parser.add_argument('--output', help='JSON file, stdout by default')
+    parser.add_argument('--verbose', action='store_true', help='keep the prints of the clients')
+    args = parser.parse_args(argv)
+
+    emulators = []
+    if args.emulate:
+        from .emulator import O2D22xEmulator, XmlRpcEmulator
+        for i in range(args.emulate):
+            host = f'127.0.0.{10 + i}'
+            pcic = O2D22xEmulator(host, 0).start()
+            rpc = XmlRpcEmulator(host, args.rpc_port).start()
+            emulators += [pcic, rpc]
+            args.pcic.append(f'{host}:{pcic.address[1]}')
+            args.rpc.append(host)
+
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cycles': args.cycles,
+            'emulated': bool(args.emulate),
+        },
+        'pcic': {},
+        'rpc': None,
+    }
+    if args.tracemalloc:
+        report['alloc'] = {}
+    out = sys.stdout if args.verbose else open(os.devnull, 'w')
+    try:
+        with contextlib.redirect_stdout(out):
+            for target in args.pcic:
+                host, port = split_target(target, args.pcic_port)
+                report['pcic'][target] = bench_pcic(host, port, args.cycles, args.warmup,
+                                                    annotate=not args.no_annotate)
+                if args.tracemalloc:
+                    report['alloc'][target] = {
+                        mode: bench_alloc(host, port, args.cycles, args.warmup, pooled=mode == 'pooled')
+                        for mode in ('pooled', 'unpooled')}
+            if args.rpc:
+                report['rpc'] = bench_rpc(args.rpc, args.rpc_port, args.cycles, min(args.warmup, 2))
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+        if out is not sys.stdout:
+            out.close()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import threading
+import numpy as np
+
+
+FRAME_SHAPE = (480, 640, 3)
+# <length> + JPEG of a 640x480 frame, the answer falls back to a fresh buffer if larger
+RECEIVE_SIZE = 1 << 20
+
+
+class PooledBuffer(object):
+    """
+    A buffer borrowed from a BufferPool, released with `release` or on leaving a with block.
+
+    with pool.acquire() as buffer:
+        ...
+    """
+    __slots__ = ('pool', 'buffer')
+
+    def __init__(self, pool, buffer) -> None:
+        self.pool = pool
+        self.buffer = buffer
+
+    def __enter__(self):
+        return self.buffer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        if self.buffer is not None:
+            self.pool.release(self.buffer)
+            self.buffer = None
+
+
+class BufferPool(object):
+    """
+    Bounded pool of reusable buffers.
+
+    At most `capacity` buffers are created with `factory`, `acquire` waits for a
+    released one when all of them are in use.
+
+    Parameters
+    ----------
+    factory:
+        function without arguments that creates a buffer.
+    capacity:
+        maximum number of buffers.
+    """
+    def __init__(self, factory, capacity=4) -> None:
+        self.factory = factory
+        self.capacity = capacity
+        self.created = 0
+        self._free = []
+        self._cond = threading.Condition()
+
+    @classmethod
+    def frames(cls, capacity=4, shape=FRAME_SHAPE, dtype=np.uint8):
+        """
+        Pool of decoded frames (numpy arrays).
+        """
+        return cls(lambda: np.empty(shape, dtype=dtype), capacity)
+
+    @classmethod
+    def receive(cls, capacity=4, size=RECEIVE_SIZE):
+        """
+        Pool of receive buffers (bytearray).
+        """
+        return cls(lambda: bytearray(size), capacity)
+
+    @property
+    def in_use(self):
+        with self._cond:
+            return self.created - len(self._free)
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a buffer.
+
+        :return: PooledBuffer, use it as context manager or call its release()
+        :raises TimeoutError: if no buffer was released within timeout
+        """
+        with self._cond:
+            if not self._free and self.created < self.capacity:
+                self.created += 1
+                return PooledBuffer(self, self.factory())
+            if not self._cond.wait_for(lambda: self._free, timeout):
+                raise TimeoutError(f'No buffer released within {timeout} s')
+            return PooledBuffer(self, self._free.pop())
+
+    def release(self, buffer):
+        with self._cond:
+            self._free.append(buffer)
+            self._cond.notify()
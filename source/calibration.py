@@ -0,0 +1,169 @@
+import json
+import os
+import numpy as np
+
+
+_loaded = {}
+
+
+class LineCalibration(object):
+    """
+    Pixel to millimetre calibration of all the cameras of a line.
+
+    Every camera has a 3x3 homography (or a 2x3 affine transform) from image pixels
+    to line millimetres. The matrices are stacked so the whole multi-camera batch is
+    converted and classified with a few array operations per cycle.
+
+    Parameters
+    ----------
+    matrices:
+        sequence of 3x3 or 2x3 matrices, one per camera.
+    img_w, img_h:
+        image size in pixels, the image centre is the reference position.
+    """
+    def __init__(self, matrices, img_w=640, img_h=480) -> None:
+        matrices = np.asarray(matrices, dtype=np.float64)
+        if matrices.size == 0:
+            matrices = np.empty((0, 3, 3))
+        if matrices.ndim != 3 or matrices.shape[1:] not in ((2, 3), (3, 3)):
+            raise ValueError('<matrices> should be a list of 3x3 or 2x3 matrices')
+        if matrices.shape[1] == 2:
+            last_row = np.broadcast_to([0.0, 0.0, 1.0], (len(matrices), 1, 3))
+            matrices = np.concatenate([matrices, last_row], axis=1)
+        self.matrices = matrices
+        self.img_w = img_w
+        self.img_h = img_h
+        self.centre_px = np.tile([img_w / 2, img_h / 2], (len(matrices), 1))
+        self.centre_mm = self.to_mm(self.centre_px)
+        # Angle of the image x axis in the line frame, added to the orientation
+        self.rotation = np.degrees(np.arctan2(matrices[:, 1, 0], matrices[:, 0, 0]))
+        self._tolerances = {}
+
+    def __len__(self):
+        return len(self.matrices)
+
+    @classmethod
+    def uniform(cls, cameras, px_per_mm=3.0, img_w=640, img_h=480):
+        """
+        Same scale for every camera, no rotation nor perspective.
+        """
+        scale = 1.0 / px_per_mm
+        affine = [[scale, 0.0, 0.0], [0.0, scale, 0.0]]
+        return cls([affine] * cameras, img_w, img_h)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a calibration file, the result is cached until the file changes.
+
+        File format (JSON):
+            {"img_w": 640, "img_h": 480,
+             "cameras": [{"homography": [[...], [...], [...]]}, {"affine": [[...], [...]]}, ...]}
+        """
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime_ns)
+        if key not in _loaded:
+            with open(path) as file:
+                config = json.load(file)
+            matrices = []
+            for camera in config['cameras']:
+                matrix = np.asarray(camera.get('homography', camera.get('affine')), dtype=np.float64)
+                if matrix.shape == (2, 3):
+                    matrix = np.vstack([matrix, [0.0, 0.0, 1.0]])
+                matrices.append(matrix)
+            _loaded[key] = cls(matrices, config.get('img_w', 640), config.get('img_h', 480))
+        return _loaded[key]
+
+    def to_mm(self, points):
+        """
+        Convert one (x, y) pixel position per camera to millimetres.
+
+        :param points: array (cameras, 2) in pixels, NaN rows stay NaN
+        :return: array (cameras, 2) in millimetres
+        """
+        points = np.asarray(points, dtype=np.float64)
+        homogeneous = np.concatenate([points, np.ones((len(points), 1))], axis=1)
+        mapped = np.einsum('nij,nj->ni', self.matrices, homogeneous)
+        return mapped[:, :2] / mapped[:, 2:]
+
+    def tolerances(self, mx, my):
+        """
+        The pixel margins around the image centre converted to millimetres, per camera.
+
+        :return: array (cameras, 2) with the x and y tolerance in millimetres
+        """
+        key = (mx, my)
+        if key not in self._tolerances:
+            edge_x = self.to_mm(self.centre_px + [mx, 0])
+            edge_y = self.to_mm(self.centre_px + [0, my])
+            self._tolerances[key] = np.stack([np.linalg.norm(edge_x - self.centre_mm, axis=1),
+                                              np.linalg.norm(edge_y - self.centre_mm, axis=1)], axis=1)
+        return self._tolerances[key]
+
+    def classify(self, results, mx, my, or_err, line_tol):
+        """
+        Convert the evaluation results of all the cameras and classify them.
+
+        :param results: list of result dicts (see evaluate_image_decoded), one per camera
+        :param mx, my: pixel margins around the image centre
+        :param or_err: orientation tolerance in degrees
+        :param line_tol: line tolerance in mm, how far the offset of a camera may be from
+                         the median offset of the cameras with a detection
+        :return: dict of arrays, one row per camera:
+            - pos         position in mm
+            - offset      centre - position, in mm
+            - offset_px   centre - position, in pixels
+            - ori         orientation in the line frame
+            - fail        no valid detection
+            - misoriented the orientation is out of tolerance
+            - outside     the detection is outside of the margins or misoriented
+            - gap         the offset is more than line_tol from the rest of the line
+        """
+        if len(results) != len(self):
+            raise ValueError(f'Expected {len(self)} results, got {len(results)}')
+        raw = np.array([(r.get('x'), r.get('y'), r.get('rot')) for r in results], dtype=np.float64)
+        fail = np.isnan(raw).any(axis=1)
+
+        pos = self.to_mm(raw[:, :2])
+        offset = self.centre_mm - pos
+        offset_px = self.centre_px - raw[:, :2]
+        ori = raw[:, 2] + self.rotation
+        with np.errstate(invalid='ignore'):
+            # A detection on the margin in pixels is inside, whatever the mm rounding error
+            tolerance = self.tolerances(mx, my)
+            beyond = (np.abs(offset) > tolerance) & ~np.isclose(np.abs(offset), tolerance)
+            misoriented = ~fail & (np.abs(ori) > or_err)
+            outside = (~fail & beyond.any(axis=1)) | misoriented
+            # Distance of every camera to the line, the median offset of the valid ones
+            line = np.median(offset[~fail], axis=0) if (~fail).any() else np.zeros(2)
+            deviation = np.linalg.norm(offset - line, axis=1)
+            gap = ~fail & (deviation > line_tol) & ~np.isclose(deviation, line_tol)
+
+        return {
+            'pos': pos,
+            'offset': offset,
+            'offset_px': offset_px,
+            'ori': ori,
+            'fail': fail,
+            'misoriented': misoriented,
+            'outside': outside,
+            'gap': gap,
+        }
+
+    @staticmethod
+    def fill(data_struct, classified):
+        """
+        Write a classified batch into a LineAnalyser.data_struct like dict.
+        """
+        values = np.nan_to_num(np.concatenate([classified['pos'], classified['ori'][:, None],
+                                               classified['offset']], axis=1)).tolist()
+        fails = classified['fail'].tolist()
+        for i, (row, fail) in enumerate(zip(values, fails)):
+            cam = data_struct.setdefault(f'CAM{i + 1}', {})
+            cam['POSX'], cam['POSY'], cam['ORIE'], cam['DESX'], cam['DESY'] = row
+            cam['FAIL'] = int(fail)
+        system = data_struct['SYSTEM']
+        system['FAIL'] = int(classified['fail'].any())
+        system['GAP'] = int(classified['gap'].any())
+        system['OUTSIDE'] = int(classified['outside'].any())
+        return data_struct
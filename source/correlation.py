@@ -0,0 +1,188 @@
+import collections
+import struct
+import time
+from .formats import serialization_format
+
+
+# Fixed part of the chunk header (header version 3), META_DATA is variable
+CHUNK_FIELDS = tuple(serialization_format[offset][0] for offset in sorted(serialization_format)
+                     if offset < 0x0030)
+CHUNK_HEADER = struct.Struct('<%dI' % len(CHUNK_FIELDS))
+
+Snapshot = collections.namedtuple('Snapshot', ['part', 'timestamp', 'results', 'complete',
+                                               'missing', 'misaligned'])
+
+
+def parse_chunk_header(data):
+    """
+    Parse the header of a binary chunk, see formats.serialization_format.
+
+    :param data: bytes-like starting at CHUNK_TYPE
+    :return: {field name: value} plus 'DEVICE_TIME' (seconds, from TIME_STAMP_SEC/NSEC,
+             or TIME_STAMP if those are 0), None if data does not start with a V3 header
+    """
+    if len(data) < CHUNK_HEADER.size:
+        return None
+    header = dict(zip(CHUNK_FIELDS, CHUNK_HEADER.unpack_from(data)))
+    if header['HEADER_VERSION'] != 3 or header['HEADER_SIZE'] < 0x40:
+        return None
+    if header['TIME_STAMP_SEC'] or header['TIME_STAMP_NSEC']:
+        header['DEVICE_TIME'] = header['TIME_STAMP_SEC'] + header['TIME_STAMP_NSEC'] * 1e-9
+    else:
+        header['DEVICE_TIME'] = header['TIME_STAMP'] * 1e-6
+    return header
+
+
+class _Part(object):
+    __slots__ = ('part', 'anchor', 'results', 'misaligned', 'closed')
+
+    def __init__(self, part, anchor) -> None:
+        self.part = part
+        self.anchor = anchor
+        self.results = {}
+        self.misaligned = set()
+        self.closed = False
+
+
+class FrameCorrelator(object):
+    """
+    Groups the results of several cameras into one snapshot per part.
+
+    Each result is placed on the host clock: the host trigger timestamp
+    (O2D22xPCICDevice.trigger_ts, time.monotonic) or, when the result comes with a
+    device timestamp (chunk header), the device time shifted by a per-camera offset.
+    A result joins the newest open part whose first result is at most `tolerance`
+    seconds away and that has no result of that camera yet, otherwise it opens a new part.
+
+    A part is emitted as soon as every camera reported, or `timeout` seconds after its
+    first result with the missing cameras listed. A camera is flagged misaligned in a
+    part when its frame count jumped (missed or extra trigger) or when it reported
+    twice within the window. Results with an already seen frame count (re-read of the
+    same frame) are dropped.
+
+    Open parts are kept in time order and only the ones inside the window are looked
+    at, so adding a result is O(1) amortised.
+
+    Parameters
+    ----------
+    cameras:
+        identifiers of the cameras of the line (e.g. the ip addresses).
+    tolerance:
+        seconds between the results of the same part.
+    timeout:
+        seconds after which an incomplete part is emitted.
+    """
+    def __init__(self, cameras, tolerance=0.05, timeout=1.0) -> None:
+        self.cameras = tuple(cameras)
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.duplicates = 0
+        self._open = collections.deque()
+        self._ready = collections.deque()
+        self._parts = 0
+        self._frames = {}
+        self._offsets = {}
+
+    def host_time(self, camera, device_time, received=None):
+        """
+        Device time (seconds) on the host clock.
+
+        The offset is the smallest received - device_time seen for the camera, i.e. the
+        sample with the shortest transfer delay.
+        """
+        if received is None:
+            received = time.monotonic()
+        offset = received - device_time
+        if camera not in self._offsets or offset < self._offsets[camera]:
+            self._offsets[camera] = offset
+        return device_time + self._offsets[camera]
+
+    def add(self, camera, result, timestamp=None, frame_count=None, device_time=None):
+        """
+        Add the result of one camera.
+
+        :param timestamp: host time.monotonic() of the trigger, now if None
+        :param frame_count: FRAME_COUNT of the result if known
+        :param device_time: device time in seconds (DEVICE_TIME of parse_chunk_header),
+                            preferred over timestamp when given
+        :return: number of the part the result was assigned to, None if dropped
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+        if device_time is not None:
+            timestamp = self.host_time(camera, device_time, timestamp)
+
+        gap = False
+        if frame_count is not None:
+            last = self._frames.get(camera)
+            if last == frame_count:
+                self.duplicates += 1
+                return None
+            gap = last is not None and frame_count != last + 1
+            self._frames[camera] = frame_count
+
+        part = None
+        for candidate in reversed(self._open):
+            if candidate.anchor < timestamp - self.tolerance:
+                break
+            if candidate.closed or candidate.anchor > timestamp + self.tolerance:
+                continue
+            if camera in candidate.results:
+                candidate.misaligned.add(camera)
+                gap = True
+                break
+            part = candidate
+            break
+        if part is None:
+            self._parts += 1
+            part = _Part(self._parts, timestamp)
+            self._open.append(part)
+        part.results[camera] = result
+        if gap:
+            part.misaligned.add(camera)
+        if len(part.results) == len(self.cameras):
+            self._emit(part)
+        self.expire(timestamp)
+        return part.part
+
+    def expire(self, now=None):
+        """
+        Emit the parts older than timeout.
+        """
+        if now is None:
+            now = time.monotonic()
+        while self._open and (self._open[0].closed or now - self._open[0].anchor > self.timeout):
+            part = self._open.popleft()
+            if not part.closed:
+                self._emit(part)
+
+    def poll(self, now=None):
+        """
+        :return: list of the snapshots emitted since the last call, in part order
+        """
+        self.expire(now)
+        ready = sorted(self._ready, key=lambda snapshot: snapshot.part)
+        self._ready.clear()
+        return ready
+
+    def flush(self):
+        """
+        Emit every open part, complete or not.
+        """
+        while self._open:
+            part = self._open.popleft()
+            if not part.closed:
+                self._emit(part)
+        return self.poll()
+
+    def _emit(self, part):
+        part.closed = True
+        missing = tuple(camera for camera in self.cameras if camera not in part.results)
+        self._ready.append(Snapshot(
+            part=part.part,
+            timestamp=part.anchor,
+            results={camera: part.results[camera] for camera in self.cameras if camera in part.results},
+            complete=not missing,
+            missing=missing,
+            misaligned=tuple(camera for camera in self.cameras if camera in part.misaligned),
+        ))
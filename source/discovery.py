@@ -0,0 +1,79 @@
+import asyncio
+import ipaddress
+import re
+import time
+from .o2d22x import parse_device_info
+
+
+PCIC_PORT = 50010
+_cache = {}
+
+
+async def probe(ip, port=PCIC_PORT, timeout=0.3):
+    """
+    Check if an O2D22x sensor answers on ip:port.
+
+    Opens the PCIC port, initialises the V3 protocol (1000v03) and requests the
+    device information (D?).
+
+    :return: the parsed device information (see parse_device_info) or None
+    """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(str(ip), port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        writer.write(b'1000v03\r\n')
+        if await asyncio.wait_for(reader.readuntil(b'\r\n'), timeout) != b'1000*\r\n':
+            return None
+        writer.write(b'1000L%09d\r\n1000D?\r\n' % (len('D?') + 6))
+        header = await asyncio.wait_for(reader.readexactly(16), timeout)
+        answer_length = int(re.findall(rb'\d+', header)[1])
+        answer = await asyncio.wait_for(reader.readexactly(answer_length), timeout)
+    except (OSError, ValueError, IndexError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError):
+        return None
+    finally:
+        writer.close()
+    info = parse_device_info(answer[4:-2].decode(errors='replace'))
+    if not isinstance(info, dict):
+        return None
+    info['pcic_address'] = str(ip)
+    info['pcic_port'] = port
+    return info
+
+
+async def discover_async(network, port=PCIC_PORT, timeout=0.3, concurrency=256):
+    """
+    Probe every host of a CIDR range concurrently.
+
+    :param network: CIDR range, e.g. "192.168.0.0/24"
+    :return: list with the device information of the sensors found, sorted by address
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded_probe(ip):
+        async with semaphore:
+            return await probe(ip, port, timeout)
+
+    hosts = list(ipaddress.ip_network(network, strict=False).hosts())
+    found = await asyncio.gather(*(bounded_probe(ip) for ip in hosts))
+    return [info for info in found if info is not None]
+
+
+def discover(network, port=PCIC_PORT, timeout=0.3, concurrency=256, ttl=60.0, refresh=False):
+    """
+    Discover the O2D22x sensors of a subnet, see discover_async.
+
+    The result is cached for `ttl` seconds per (network, port), use refresh=True to
+    probe again.
+
+    IP_LIST = [info['pcic_address'] for info in discover("192.168.0.0/24")]
+    """
+    key = (str(ipaddress.ip_network(network, strict=False)), port)
+    cached = _cache.get(key)
+    if cached is not None and not refresh and time.monotonic() - cached[0] < ttl:
+        return list(cached[1])
+    found = asyncio.run(discover_async(network, port, timeout, concurrency))
+    _cache[key] = (time.monotonic(), found)
+    return list(found)
@@ -0,0 +1,246 @@
+import re
+import socketserver
+import threading
+import time
+from xmlrpc.server import SimpleXMLRPCServer
+import cv2
+import numpy as np
+
+
+def synthetic_image(width=640, height=480, x=320, y=240):
+    """
+    JPEG of a dark frame with a bright object at (x, y), used as the emulated camera image.
+    """
+    img = np.full((height, width, 3), 40, dtype=np.uint8)
+    cv2.circle(img, (int(x), int(y)), 30, (220, 220, 220), -1)
+    ok, jpeg = cv2.imencode('.jpg', img)
+    return jpeg.tobytes()
+
+
+class _PCICHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        emulator = self.server.emulator
+        sock = self.request
+        if self._recv_until(sock, b'\r\n') != b'1000v03\r\n':
+            return
+        sock.sendall(b'1000*\r\n')
+        while True:
+            header = self._recv_exactly(sock, 16)
+            if header is None:
+                return
+            length = int(re.findall(rb'\d+', header)[1])
+            body = self._recv_exactly(sock, length)
+            if body is None:
+                return
+            ticket, cmd = body[:4], body[4:-2]
+            answer = emulator.answer(cmd)
+            sock.sendall(ticket + b'L%09d\r\n' % (len(answer) + 6) + ticket + answer + b'\r\n')
+
+    @staticmethod
+    def _recv_exactly(sock, number_bytes):
+        data = bytearray()
+        while len(data) < number_bytes:
+            part = sock.recv(number_bytes - len(data))
+            if not part:
+                return None
+            data += part
+        return bytes(data)
+
+    @staticmethod
+    def _recv_until(sock, end):
+        data = bytearray()
+        while not data.endswith(end):
+            part = sock.recv(1)
+            if not part:
+                break
+            data += part
+        return bytes(data)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class O2D22xEmulator(object):
+    """
+    Loopback stand-in of an O2D22x sensor speaking PCIC V3.
+
+    Answers the commands used by O2D22xPCICDevice (t, T?, R?, I?, F?, c, p, v, a?,
+    s?, E?, V?, D?) with fixed data, so discovery, benchmarks and tests can run
+    without hardware.
+
+    Parameters
+    ----------
+    host, port:
+        address to listen on, port 0 picks a free one (see `address`).
+    result:
+        result answered to T?/R?.
+    image:
+        JPEG bytes answered to I?/F?, a synthetic frame by default.
+    delay:
+        seconds spent "evaluating" each trigger.
+    switch_delay:
+        seconds spent changing the application.
+    """
+    def __init__(self, host='127.0.0.1', port=0, result='startPASS#0.95#1#1#320#240#0.5#0.9stop',
+                 image=None, delay=0.0, name='emulator', switch_delay=0.0) -> None:
+        self.result = result
+        self.image = image if image is not None else synthetic_image()
+        self.delay = delay
+        self.switch_delay = switch_delay
+        self.switches = 0
+        self.name = name
+        self.application = 1
+        self.statistics = [0, 0, 0]
+        self._server = _Server((host, port), _PCICHandler, bind_and_activate=True)
+        self._server.emulator = self
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def device_information(self):
+        ip, port = self.address
+        return '\t'.join(['IFM ELECTRONIC', 'O2D220AC', self.name, 'loopback', ip,
+                          '255.0.0.0', '0.0.0.0', '00:02:01:00:00:00', '0', '8080'])
+
+    def answer(self, cmd):
+        if cmd in (b't', b'T?'):
+            if self.delay:
+                time.sleep(self.delay)
+            passed = 'PASS' in self.result
+            self.statistics[0] += 1
+            self.statistics[1 if passed else 2] += 1
+            if cmd == b't':
+                return b'*'
+            return self.result.encode('ascii')
+        if cmd == b'R?':
+            return self.result.encode('ascii')
+        if cmd in (b'I?', b'F?'):
+            return b'%09d' % len(self.image) + self.image
+        if cmd[:1] == b'c':
+            if self.switch_delay:
+                time.sleep(self.switch_delay)
+            self.switches += 1
+            self.application = int(cmd[2:])
+            return b'*'
+        if cmd[:1] in (b'p', b'v'):
+            return b'*'
+        if cmd == b'a?':
+            return b'001 0%02d' % self.application
+        if cmd == b's?':
+            return ('%d %d %d' % tuple(self.statistics)).encode()
+        if cmd == b'E?':
+            return b'0000'
+        if cmd == b'V?':
+            return b'03 01 03'
+        if cmd == b'D?':
+            return self.device_information().encode()
+        return b'?'
+
+
+class XmlRpcEmulator(object):
+    """
+    Loopback stand-in of the XML-RPC interface used by XmlRpcCameraProxy.
+
+    Parameters
+    ----------
+    host, port:
+        address to listen on, port 0 picks a free one (see `address`).
+    delay:
+        seconds spent "evaluating" each trigger.
+    """
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, mac='00:02:01:00:00:00',
+                 firmware='1.27.9941') -> None:
+        self.delay = delay
+        self.mac = mac
+        self.firmware = firmware
+        self.calls = {}
+        self.detection = [1, 'Ak0xAw__', 260.440002, 0.959605, 335.676086, 87.168205, 0.908069,
+                          17, 627, 455, 57, 79]
+        self._server = SimpleXMLRPCServer((host, port), logRequests=False, allow_none=True)
+        self._server.register_instance(self, allow_dotted_names=False)
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _dispatch(self, method, params):
+        if not method.startswith('xml') or not hasattr(self, method):
+            raise Exception(f'method "{method}" is not supported')
+        self.calls[method] = self.calls.get(method, 0) + 1
+        return getattr(self, method)(*params)
+
+    def xmlConnect(self, ip, platform):
+        return [0, 1, 1, 'O2D220AC', self.firmware]
+
+    def xmlDisconnect(self, ip):
+        return [0]
+
+    def xmlGetNetworkParameters(self):
+        ip, port = self.address
+        return [0, 0, ip, '255.0.0.0', '0.0.0.0', port, 50002, self.mac]
+
+    def xmlGetCompatibleCPVersions(self):
+        return [0, 2, '3.5.0061', '3.5.0062']
+
+    def xmlGetConfigList(self):
+        return [0, 1, 0, 1, 1]
+
+    def xmlOpenConfiguration(self, config_id, mode):
+        return [0]
+
+    def xmlTestConfig(self, state):
+        return [0]
+
+    def xmlResumeResults(self):
+        return [0]
+
+    def xmlExecuteTrigger(self):
+        if self.delay:
+            time.sleep(self.delay)
+        return [0]
+
+    def xmlPollResults(self):
+        return [0, 1]
+
+    def xmlGetConfigRunResults(self):
+        return [0, 1]
+
+    def xmlGetConfigInstances(self, instance):
+        return [0, 1, self.detection, 322.972]
@@ -0,0 +1,164 @@
+import collections
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+
+
+class ApplicationJobQueue(object):
+    """
+    Evaluation queue of one O2D22xPCICDevice that groups the jobs by application.
+
+    Every job is tagged with the application it needs. The worker keeps running the
+    jobs of the active application and only switches (select_application, the
+    slowest command of the device) when no job of it is left or when the oldest
+    waiting job of another application has waited more than `max_delay` seconds.
+    Jobs of the same application always run in submission order.
+
+    Once the queue is running, every command of the device must go through it.
+
+    Parameters
+    ----------
+    device:
+        O2D22xPCICDevice owned by the queue.
+    max_delay:
+        seconds a job may wait for the active application before a switch is forced.
+    history:
+        number of recent queueing delays kept for the percentiles of `stats`.
+    """
+    def __init__(self, device, max_delay=0.1, history=1000) -> None:
+        self.device = device
+        self.max_delay = max_delay
+        self._queues = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._running = True
+        self._jobs = 0
+        self._switches = 0
+        self._switch_time = 0.0
+        self._fifo_switches = 0
+        self._last_submitted = None
+        self._delays = collections.deque(maxlen=history)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, application, method='evaluate_image_decoded', *args, **kwargs):
+        """
+        Queue a job.
+
+        :param application: application number the job needs
+        :param method: name of a device method or a callable that receives the device
+        :return: concurrent.futures.Future with the answer, RuntimeError if the
+                 application could not be selected
+        """
+        application = str(application).zfill(2)
+        future = Future()
+        with self._cond:
+            if not self._running:
+                raise RuntimeError('Job queue closed')
+            if self._last_submitted is not None and self._last_submitted != application:
+                self._fifo_switches += 1
+            self._last_submitted = application
+            queue = self._queues.setdefault(application, collections.deque())
+            queue.append((time.monotonic(), future, method, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def evaluate(self, application, timeout=None):
+        """
+        Queue an evaluation and wait for its decoded result.
+        """
+        return self.submit(application).result(timeout)
+
+    @property
+    def pending(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def stats(self):
+        """
+        :return: {'jobs', 'pending', 'switches', 'fifo_switches', 'switch_ms_mean',
+                 'queue_delay_ms': {'mean', 'p50', 'p95', 'max'} or None}
+                 fifo_switches is what running the jobs in submission order would have cost
+        """
+        with self._cond:
+            delays = np.asarray(self._delays) * 1000.0
+            stats = {
+                'jobs': self._jobs,
+                'pending': sum(len(queue) for queue in self._queues.values()),
+                'switches': self._switches,
+                'fifo_switches': self._fifo_switches,
+                'switch_ms_mean': self._switch_time * 1000.0 / self._switches if self._switches else None,
+                'queue_delay_ms': None,
+            }
+        if len(delays):
+            p50, p95 = np.percentile(delays, [50, 95])
+            stats['queue_delay_ms'] = {'mean': float(delays.mean()), 'p50': float(p50),
+                                       'p95': float(p95), 'max': float(delays.max())}
+        return stats
+
+    def close(self):
+        """
+        Run the jobs already queued and stop the worker.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _choose(self, now):
+        """
+        Application of the next job: the active one unless another job is overdue.
+        """
+        oldest = min(self._queues, key=lambda application: self._queues[application][0][0])
+        active = self.device.active_application
+        if active in self._queues and now - self._queues[oldest][0][0] <= self.max_delay:
+            return active
+        return oldest
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._queues:
+                    now = time.monotonic()
+                    application = self._choose(now)
+                    queue = self._queues[application]
+                    enqueued, future, method, args, kwargs = queue.popleft()
+                    if not queue:
+                        del self._queues[application]
+                    self._delays.append(now - enqueued)
+                    self._jobs += 1
+                    return application, future, method, args, kwargs
+                if not self._running:
+                    return None
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            application, future, method, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if self.device.active_application != application:
+                    start = time.perf_counter()
+                    result = self.device.select_application(application)
+                    with self._cond:
+                        self._switches += 1
+                        self._switch_time += time.perf_counter() - start
+                    if result != '*':
+                        raise RuntimeError(f'Application {application} could not be selected: {result}')
+                if callable(method):
+                    future.set_result(method(self.device, *args, **kwargs))
+                else:
+                    future.set_result(getattr(self.device, method)(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
@@ -0,0 +1,164 @@
+class LazyImage(object):
+    """
+    Handle to the image of one evaluation. The image is only transferred (I?/F?)
+    and decoded the first time `raw` or `image` is accessed.
+
+    The device only keeps the image of its last evaluation, so the handle must be
+    resolved before the camera is triggered again, otherwise a RuntimeError is raised.
+    Call `fetch` to pin the raw bytes before triggering.
+
+    With buffer pools (see ImagePolicy) the answer is received into a pooled buffer
+    and decoded into a pooled frame, `release` returns both; the handle can not be
+    used afterwards. Without a free buffer a new one is allocated as before.
+
+    Parameters
+    ----------
+    device:
+        O2D22xPCICDevice the evaluation was made on.
+    result:
+        result field of the evaluation ('0PASS', '0FAIL' ...), selects I? or F?.
+    enabled:
+        False if the image policy discarded this image, `raw` and `image` return None.
+    frames, receive:
+        optional BufferPool of decoded frames and of receive buffers.
+    """
+    def __init__(self, device, result, enabled=True, frames=None, receive=None) -> None:
+        self.device = device
+        self.result = result
+        self.enabled = enabled
+        self.evaluation = device.evaluations
+        self.frames = frames
+        self.receive = receive
+        self.released = False
+        self._raw = None
+        self._image = None
+        self._buffers = []
+
+    def __repr__(self):
+        state = 'fetched' if self.fetched else ('pending' if self.enabled else 'discarded')
+        return f"LazyImage({self.device.ip_address}, {self.result}, {state})"
+
+    @property
+    def fetched(self):
+        return self._raw is not None
+
+    @property
+    def decoded(self):
+        return self._image is not None
+
+    @property
+    def stale(self):
+        """
+        True if the device evaluated again and the image is no longer available.
+        """
+        return not self.fetched and self.device.evaluations != self.evaluation
+
+    @property
+    def raw(self):
+        """
+        The <length><image data> answer of the device, b'!' if it was rejected.
+        """
+        if self._raw is None:
+            if not self.enabled:
+                return None
+            if self.released:
+                raise RuntimeError(f"<{self.device.ip_address}> Image already released")
+            if self.stale:
+                raise RuntimeError(f"<{self.device.ip_address}> Image overwritten by a newer evaluation")
+            buffer = self._borrow(self.receive)
+            self._raw = self.device.request_image(self.result, buffer)
+        return self._raw
+
+    @property
+    def image(self):
+        """
+        The decoded image as numpy array, None if it is not available.
+        """
+        if self._image is None:
+            raw = self.raw
+            if raw is None or raw == b'!':
+                return None
+            self._image = self.device.decode_image(raw, self._borrow(self.frames))
+        return self._image
+
+    def fetch(self):
+        """
+        Transfer the raw image now, without decoding it.
+        """
+        self.raw
+        return self
+
+    def release(self):
+        """
+        Return the pooled buffers, the raw and decoded image must not be used anymore.
+        """
+        self.released = True
+        self._raw = None
+        self._image = None
+        for buffer in self._buffers:
+            buffer.release()
+        self._buffers = []
+
+    def _borrow(self, pool):
+        if pool is None:
+            return None
+        try:
+            borrowed = pool.acquire(timeout=0)
+        except TimeoutError:
+            return None
+        self._buffers.append(borrowed)
+        return borrowed.buffer
+
+
+class ImagePolicy(object):
+    """
+    Decides which evaluations keep their image.
+
+    Parameters
+    ----------
+    mode:
+        - always      every evaluation has an image
+        - fail_only   only evaluations that did not PASS
+        - sampled     one of every `every` evaluations per device
+        - never       no images
+    every:
+        sampling period for the 'sampled' mode.
+    prefetch:
+        transfer the kept images right after the evaluation instead of on access.
+    frames, receive:
+        optional BufferPool of decoded frames and of receive buffers given to the
+        LazyImage handles, see LazyImage.release.
+    """
+    MODES = ('always', 'fail_only', 'sampled', 'never')
+
+    def __init__(self, mode='always', every=1, prefetch=False, frames=None, receive=None) -> None:
+        if mode not in self.MODES:
+            raise ValueError(f'<mode> should be one of {self.MODES}')
+        if every < 1:
+            raise ValueError('<every> should be greater than 0')
+        self.mode = mode
+        self.every = every
+        self.prefetch = prefetch
+        self.frames = frames
+        self.receive = receive
+        self._counters = {}
+
+    def wants(self, device, result):
+        if self.mode == 'always':
+            return True
+        if self.mode == 'fail_only':
+            return not str(result).endswith('PASS')
+        if self.mode == 'sampled':
+            count = self._counters.get(device.ip_address, 0)
+            self._counters[device.ip_address] = count + 1
+            return count % self.every == 0
+        return False
+
+    def handle(self, device, result):
+        """
+        Return the LazyImage for the last evaluation of the device.
+        """
+        image = LazyImage(device, result, self.wants(device, result), self.frames, self.receive)
+        if self.prefetch and image.enabled:
+            image.fetch()
+        return image
@@ -1,9 +1,75 @@
 import socket
 import re
+import time
 import cv2
+import numpy as np
 import matplotlib.image as mpimg
 from io import BytesIO
 from .formats import error_codes, error_solutions
+from .result_parser import parse_result
+
+# Directions of the frames recorded by source.recorder.TrafficRecorder
+SENT = 0
+RECEIVED = 1
+
+def parse_device_info(trama):
+    """
+    Parse the answer of the D? command (see O2D22xPCICDevice.request_device_information)
+
+    :return: dict with the device information or "Invalid trama format"
+    """
+    info = trama.split('\t')
+    if len(info) != 10:
+        return "Invalid trama format"
+    
+    parsed_data = {
+        'vendor': info[0],
+        'article': info[1],
+        'name': info[2],
+        'location': info[3],
+        'ip': info[4],
+        'subnet': info[5],
+        'gateway': info[6],
+        'MAC': info[7],
+        'DHCP': info[8],
+        'port': info[9]
+    }
+    return parsed_data
+
+
+def decode_result(trama):
+    """
+    Decode a T?/R? answer (see O2D22xPCICDevice.request_last_result)
+
+    :return: dict with result, match, instances and index, x, y, rot, quality of the
+             first instance (None if the result is not PASS), all the instances as
+             structured array in 'all_instances' (see parse_result), or "!"
+    """
+    parsed = parse_result(trama)
+    if parsed == '!':
+        return parsed
+
+    res_dic = {}
+    res_dic['result'] = parsed.result
+    res_dic['match'] = parsed.match
+    res_dic['instances'] = parsed.count
+    if parsed.result == "PASS" and parsed.count:
+        first = parsed.instances[0]
+        res_dic['index'] = int(first['index'])
+        res_dic['x'] = int(first['x'])
+        res_dic['y'] = int(first['y'])
+        res_dic['rot'] = float(first['rot'])
+        res_dic['quality'] = float(first['quality'])
+    else:
+        res_dic['index'] = None
+        res_dic['x'] = None
+        res_dic['y'] = None
+        res_dic['rot'] = None
+        res_dic['quality'] = None
+    res_dic['all_instances'] = parsed.instances
+
+    return res_dic
+
 
 class Client(object):
     def __init__(self, address, port) -> None:
@@ -21,6 +87,8 @@ class Client(object):
         except Exception as e:
             print(f"Error: {e}")
         self.recv_counter = 0
+        # Optional source.recorder.TrafficRecorder, records the raw frames
+        self.recorder = None
         self.debug = False
         self.debugFull = False
 
@@ -40,10 +108,27 @@ class Client(object):
             data_part = self.pcicSocket.recv(number_bytes - len(data))
             if len(data_part) == 0:
                 raise RuntimeError("Connection to server closed")
-            data = data + data_part
+            data += data_part
         self.recv_counter += number_bytes
         return data
 
+    def recv_into(self, view, number_bytes):
+        """
+        Read the next bytes of the answer into an existing buffer, without allocating.
+
+        :param view: (memoryview) destination, at least number_bytes long
+        :param number_bytes: (int) length of bytes
+        :return: the filled part of view
+        """
+        received = 0
+        while received < number_bytes:
+            count = self.pcicSocket.recv_into(view[received:number_bytes], number_bytes - received)
+            if count == 0:
+                raise RuntimeError("Connection to server closed")
+            received += count
+        self.recv_counter += number_bytes
+        return view[:number_bytes]
+
     def close(self):
         """
         Close the socket session with the device.
@@ -53,57 +138,81 @@ class Client(object):
         self.pcicSocket.close()
 
 class PCICV3Client(Client):
-    def read_next_answer(self):
+    def read_next_answer(self, into=None):
         """
         Read next available answer.
 
-        :return: None
+        :param into: (bytearray) optional buffer (e.g. from a BufferPool) the answer is
+                     read into, the answer is then a memoryview on it. Answers that
+                     do not fit are read into a new buffer.
+        :return: ticket, answer
         """
         # read PCIC ticket + ticket length
-        answer = self.recv(16)
-        # print("RAW response: ", answer, end=" ")
-        ticket = answer[0:4]
-        answer_length = int(re.findall(r'\d+', str(answer))[1])
-        answer = self.recv(answer_length)
+        header = self.recv(16)
+        # print("RAW response: ", header, end=" ")
+        ticket = header[0:4]
+        answer_length = int(re.findall(r'\d+', str(header))[1])
+        if into is not None and answer_length <= len(into):
+            answer = self.recv_into(memoryview(into), answer_length)
+        else:
+            answer = self.recv(answer_length)
         # print(answer)
+        if self.recorder is not None:
+            self.recorder.record(RECEIVED, header, answer)
         return ticket, answer[4:-2]
 
-    def read_answer(self, ticket):
+    def read_answer(self, ticket, into=None):
         """
         Read the next available answer with a defined ticket number.
 
         :param ticket: (string) ticket number
+        :param into: optional receive buffer, see read_next_answer
         :return: answer of the device as a string
         """
         recv_ticket = ""
         answer = ""
         while recv_ticket != ticket.encode():
-            recv_ticket, answer = self.read_next_answer()
+            recv_ticket, answer = self.read_next_answer(into)
         return answer
 
-    def send_command(self, cmd):
+    def send_command(self, cmd, into=None):
         """
         Send a command to the device with 1000 as default ticket number. The length and syntax
         of the command is calculated and generated automatically.
 
         :param cmd: (string) Command which you want to send to the device.
+        :param into: optional receive buffer for the answer, see read_next_answer
         :return: answer of the device as a string
         """
         cmd_length = len(cmd) + 6
         length_header = str.encode("1000L%09d\r\n" % cmd_length)
-        self.pcicSocket.sendall(length_header)
         # print(f'Sended -> {length_header}', end=" ")
         msg = b"1000" + cmd.encode() + b"\r\n"
-        self.pcicSocket.sendall(msg)
-        # print(f'{msg}')
-        answer = self.read_answer("1000")
-        return answer
+        # Header and command in one write, otherwise Nagle + delayed ACK stall every command
+        frame = length_header + msg
+        if self.recorder is None:
+            self.pcicSocket.sendall(frame)
+            return self.read_answer("1000", into)
+        self.recorder.record(SENT, frame)
+        try:
+            self.pcicSocket.sendall(frame)
+            return self.read_answer("1000", into)
+        except Exception:
+            if self.recorder.dump_path is not None:
+                self.recorder.dump()
+            raise
 
 
 class O2D22xPCICDevice(PCICV3Client):
     def __init__(self, ip, port) -> None:
         self.ip_address = ip
         self.port = port
+        # Number of triggers sent, the device only keeps the image of the last one
+        self.evaluations = 0
+        # Application selected through this client, None when unknown
+        self.active_application = None
+        # time.monotonic() of the last trigger sent, for source.correlation
+        self.trigger_ts = None
         super(O2D22xPCICDevice, self).__init__(ip, port)
         
     def trigger_pulse(self):
@@ -117,8 +226,10 @@ class O2D22xPCICDevice(PCICV3Client):
               | Device is in an invalid state for the command, e.g. administer applications
               | Another trigger source has been selected for the device.
         """
+        self.trigger_ts = time.monotonic()
         result = self.send_command('t')
         result = result.decode()
+        self.evaluations += 1
         return result
     
     def set_protocol_version(self, version=3):
@@ -158,10 +269,32 @@ class O2D22xPCICDevice(PCICV3Client):
             - ! The device is in an invalid state, e.g. administer applications
               | Invalid or not existing group or application number
         """
-        command = 'c' + '0' + str(application_number).zfill(2)
+        application = str(application_number).zfill(2)
+        command = 'c' + '0' + application
+        self.active_application = None
         result = self.send_command(command)
         result = result.decode()
+        if result == '*':
+            self.active_application = application
         return result
+
+    def ensure_application(self, application_number: [str, int]) -> str:
+        """
+        Select the application only if it is not the one this client selected last.
+
+        Switching is the slowest command of the device. The cache does not see a
+        change made through another interface (XML-RPC, web UI), call
+        select_application directly when that can happen.
+
+        Returns
+        -------
+        result :
+            - \* Application active (already or after the change)
+            - ! see select_application
+        """
+        if self.active_application == str(application_number).zfill(2):
+            return '*'
+        return self.select_application(application_number)
     
     def activate_result_output(self, digit):
         """
@@ -294,7 +427,7 @@ class O2D22xPCICDevice(PCICV3Client):
             return '$'
         return result
     
-    def request_last_image(self):
+    def request_last_image(self, into=None):
         """
         Request the last image from the device
 
@@ -310,8 +443,9 @@ class O2D22xPCICDevice(PCICV3Client):
               |  Sensor is working.
 
         Image data format according to setting in the operating program
+        Pass a receive buffer in `into` to avoid allocating (see read_next_answer)
         """
-        result = self.send_command('I?')
+        result = self.send_command('I?', into)
         return result
     
     def request_last_result(self):
@@ -348,38 +482,28 @@ class O2D22xPCICDevice(PCICV3Client):
               | Application is being edited
               | Current trigger mode set not via TCP/IP
         """
+        self.trigger_ts = time.monotonic()
         result = self.send_command('T?')
         result = result.decode('ascii')
-        print(result)
+        self.evaluations += 1
+        if self.debug:
+            print(result)
         return result
     
     def evaluate_image_decoded(self):
-        trama = self.evaluate_image()
-        if trama == '!':
-            return trama
-        else:
-            parts = trama.split('#')
-            parts[0] = parts[0].replace('start', '')
-            parts[-1] = parts[-1].replace('stop', '')
-
-            res_dic = {}
-            res_dic['result'] = parts[0]
-            res_dic['match'] = float(parts[1])
-            res_dic['instances'] = int(parts[2])
-            if parts[0] == "PASS":
-                res_dic['index'] = int(parts[3])
-                res_dic['x'] = int(parts[4])
-                res_dic['y'] = int(parts[5])
-                res_dic['rot'] = float(parts[6])
-                res_dic['quality'] = float(parts[7])
-            else:
-                res_dic['index'] = None
-                res_dic['x'] = None
-                res_dic['y'] = None
-                res_dic['rot'] = None
-                res_dic['quality'] = None
+        return decode_result(self.evaluate_image())
+    
+    def evaluate_image_parsed(self):
+        """
+        Release the trigger and parse every instance of the result, see parse_result
+        """
+        return parse_result(self.evaluate_image())
 
-        return res_dic
+    def request_last_result_parsed(self):
+        """
+        Parse every instance of the last result, see parse_result
+        """
+        return parse_result(self.request_last_result())
     
     def request_protocol_version(self):
         """
@@ -424,26 +548,9 @@ class O2D22xPCICDevice(PCICV3Client):
         return result
     
     def request_device_info_decoded(self):
-        trama = self.request_device_information()
-        info = trama.split('\t')
-        if len(info) != 10:
-            return "Invalid trama format"
-        
-        parsed_data = {
-            'vendor': info[0],
-            'article': info[1],
-            'name': info[2],
-            'location': info[3],
-            'ip': info[4],
-            'subnet': info[5],
-            'gateway': info[6],
-            'MAC': info[7],
-            'DHCP': info[8],
-            'port': info[9]
-        }
-        return parsed_data
+        return parse_device_info(self.request_device_information())
     
-    def request_last_bad_img(self):
+    def request_last_bad_img(self, into=None):
         """
         Request the last "bad" image from the device
 
@@ -460,18 +567,49 @@ class O2D22xPCICDevice(PCICV3Client):
               | Sensor is working.
 
             Image data format according to setting in the operating program
+            Pass a receive buffer in `into` to avoid allocating (see read_next_answer)
         """
-        result = self.send_command('F?')
+        result = self.send_command('F?', into)
         return result
     
-    def request_image_decoded(self, result):
-        if result == "0PASS":
-            trama = self.request_last_image()
-        elif result == "0FAIL":
-            trama = self.request_last_bad_img()
+    def request_image(self, result, into=None):
+        """
+        Request the raw image that belongs to an evaluation result, the last image
+        for a PASS and the last "bad" image otherwise.
 
-        if trama == "!":
+        Returns
+        -------
+        result :
+            - Syntax: <length><image data>
+            - ! see request_last_image / request_last_bad_img
+        """
+        if str(result).endswith("PASS"):
+            return self.request_last_image(into)
+        return self.request_last_bad_img(into)
+
+    @staticmethod
+    def decode_image(trama, out=None):
+        """
+        Decode a <length><image data> answer (JPEG) into an image array.
+
+        :param out: optional destination array (e.g. from BufferPool.frames), the decoded
+                    image is copied into it if it has the same shape. This does not make
+                    the decode allocation free: cv2.imdecode has no destination argument in
+                    Python (nor can Pillow map a 3 channel array), so a temporary frame is
+                    still allocated per call, only the long lived one is reused
+        :return: the image as numpy array or "!" if the device rejected the request
+        """
+        if trama == b"!":
             return "!"
+
+        if out is not None:
+            # Same channel order as below. cv2.imdecode can not write into `out`, its
+            # result (one frame) is copied and freed right away
+            decoded = cv2.imdecode(np.frombuffer(trama, dtype=np.uint8)[9:], cv2.IMREAD_COLOR)
+            if decoded is None or decoded.shape != out.shape:
+                return decoded
+            np.copyto(out, decoded)
+            return out
         
         img_hex = trama[9:]
         img = mpimg.imread(BytesIO(img_hex), format='jpg')
@@ -479,3 +617,5 @@ class O2D22xPCICDevice(PCICV3Client):
 
         return img_rgb
 
+    def request_image_decoded(self, result, out=None):
+        return self.decode_image(self.request_image(result), out)
@@ -0,0 +1,163 @@
+import queue
+import threading
+import time
+from collections import namedtuple
+from .buffer_pool import BufferPool
+
+
+Frame = namedtuple('Frame', ['seq', 'trigger_ts', 'result', 'image'])
+_Acquired = namedtuple('_Acquired', ['seq', 'trigger_ts', 'result', 'raw', 'error', 'buffer'])
+
+
+class PipelinedAcquisition(object):
+    """
+    Pipelined acquisition mode for a O2D22xPCICDevice on continuous lines.
+
+    A background thread runs trigger + evaluation (T?) and fetches the raw image
+    of the same cycle (I?/F?) right after it, so every result is paired with its own
+    image. The raw frames go through a bounded queue (`depth` frames, 2 = double
+    buffer) and are decoded by the consumer in `get`, meanwhile the device is
+    already evaluating the next cycle.
+
+    While the pipeline is running the acquisition thread owns the socket of the
+    device, do not send other commands to it until `stop` returns.
+
+    Parameters
+    ----------
+    device:
+        O2D22xPCICDevice to acquire from.
+    application:
+        application number selected once before starting, None keeps the active one.
+    depth:
+        number of cycles the acquisition can run ahead of the consumer.
+    images:
+        fetch the image of every cycle, False only returns the evaluation results.
+    pool:
+        optional BufferPool of decoded frames (BufferPool.frames). The images are then
+        decoded into pooled frames, give them back with `release`, and the raw
+        answers are received into internal pooled buffers.
+    """
+    def __init__(self, device, application=None, depth=2, images=True, pool=None) -> None:
+        self.device = device
+        self.application = application
+        self.images = images
+        self.pool = pool
+        # Queued cycles, the one being acquired and the one being decoded
+        self.receive = BufferPool.receive(depth + 2) if pool is not None else None
+        # id(image) -> PooledBuffer of the frames handed out by get
+        self._lent = {}
+        self.frames = queue.Queue(maxsize=depth)
+        self.seq = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def __iter__(self):
+        # Timed gets: the acquisition may stop (e.g. stop() from another thread)
+        # between the check and the wait
+        while True:
+            try:
+                yield self.get(timeout=0.1)
+            except queue.Empty:
+                if not self.running and self.frames.empty():
+                    return
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        if self.application is not None:
+            self.device.select_application(self.application)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._acquire, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the acquisition after the cycle in progress, frames already acquired stay queued.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _acquire(self):
+        while not self._stop.is_set():
+            trigger_ts = time.monotonic()
+            buffer = None
+            try:
+                result = self.device.evaluate_image_decoded()
+                raw = None
+                if self.images and result != '!':
+                    buffer = _borrow(self.receive)
+                    raw = self.device.request_image(result['result'], buffer and buffer.buffer)
+            except Exception as e:
+                if buffer is not None:
+                    buffer.release()
+                self._put(_Acquired(self.seq, trigger_ts, None, None, e, None))
+                return
+            if not self._put(_Acquired(self.seq, trigger_ts, result, raw, None, buffer)):
+                if buffer is not None:
+                    buffer.release()
+                return
+            self.seq += 1
+
+    def get(self, timeout=None):
+        """
+        Return the next cycle in order, decoding its image.
+
+        :return: Frame(seq, trigger_ts, result, image), image is None when images are disabled
+        :raises queue.Empty: when no frame arrived within timeout
+        """
+        acquired = self.frames.get(timeout=timeout)
+        if acquired.error is not None:
+            raise acquired.error
+        image = None
+        if acquired.raw is not None:
+            frame = _borrow(self.pool)
+            image = self.device.decode_image(acquired.raw, frame and frame.buffer)
+            if frame is not None:
+                if image is frame.buffer:
+                    self._lent[id(image)] = frame
+                else:
+                    frame.release()
+        if acquired.buffer is not None:
+            acquired.buffer.release()
+        return Frame(acquired.seq, acquired.trigger_ts, acquired.result, image)
+
+    def release(self, frame):
+        """
+        Give the image of a Frame back to the pool, it must not be used anymore.
+        """
+        pooled = self._lent.pop(id(frame.image), None)
+        if pooled is not None:
+            pooled.release()
+
+
+def _borrow(pool):
+    """
+    A PooledBuffer, None without pool or when all the buffers are in use.
+    """
+    if pool is None:
+        return None
+    try:
+        return pool.acquire(timeout=0)
+    except TimeoutError:
+        return None
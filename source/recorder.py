@@ -0,0 +1,231 @@
+"""
+Raw PCIC traffic recorder and replay.
+
+    python -m source.recorder capture.bin              list the recorded frames
+    python -m source.recorder capture.bin --parse      replay the answers through the client parsing
+    python -m source.recorder capture.bin --profile    same, under cProfile
+"""
+import argparse
+import collections
+import cProfile
+import io
+import struct
+import sys
+import time
+from .o2d22x import PCICV3Client, decode_result, SENT, RECEIVED
+
+
+# Frame header: monotonic timestamp (ns), direction, length of the data
+FRAME = struct.Struct('<QBI')
+MAGIC = b'PCICREC1'
+# Set in the direction of a frame cut to the buffer size, its data is not a whole frame
+TRUNCATED = 0x80
+
+# Bound once, record() runs on every command
+_FRAME_SIZE = FRAME.size
+_pack_frame = FRAME.pack_into
+_now = time.monotonic_ns
+
+
+class TrafficRecorder(object):
+    """
+    Records the raw PCIC frames of a client in memory.
+
+    Two fixed buffers are used in turn: when the current one is full the other one
+    is cleared and becomes current, so the last `capacity` to 2 * `capacity` bytes
+    of traffic are always kept and nothing is allocated while recording.
+    `record` is not locked, use one recorder per client (per thread).
+
+    client.recorder = TrafficRecorder(dump_path='cam1.bin')
+
+    Parameters
+    ----------
+    capacity:
+        size in bytes of each buffer, larger frames are truncated and flagged
+        TRUNCATED (replay skips them).
+    dump_path:
+        file written by `dump` by default and when the client hits an error.
+    name:
+        label stored in the dump (e.g. the camera address).
+    """
+    def __init__(self, capacity=1 << 22, dump_path=None, name='') -> None:
+        self.capacity = capacity
+        self.dump_path = dump_path
+        self.name = name
+        # memoryviews, slice assignment is about twice as fast as on the bytearray
+        self._current = memoryview(bytearray(capacity))
+        self._previous = memoryview(bytearray(capacity))
+        self._previous_length = 0
+        self._pos = 0
+
+    def record(self, direction, data, body=b''):
+        """
+        Record one frame, SENT or RECEIVED.
+
+        :param body: second part of the frame, written right after data so a
+                     header and its answer need not be concatenated first
+        """
+        pos = self._pos
+        head = len(data)
+        length = head + len(body)
+        end = pos + _FRAME_SIZE + length
+        if end > self.capacity:
+            self._current, self._previous = self._previous, self._current
+            self._previous_length = pos
+            pos = 0
+            if _FRAME_SIZE + length > self.capacity:
+                direction |= TRUNCATED
+                length = self.capacity - _FRAME_SIZE
+                if head >= length:
+                    data, head, body = data[:length], length, b''
+                else:
+                    body = body[:length - head]
+            end = _FRAME_SIZE + length
+        buffer = self._current
+        _pack_frame(buffer, pos, _now(), direction, length)
+        start = pos + _FRAME_SIZE
+        buffer[start:start + head] = data
+        if body:
+            buffer[start + head:end] = body
+        self._pos = end
+
+    def clear(self):
+        self._previous_length = 0
+        self._pos = 0
+
+    def dump(self, path=None):
+        """
+        Write the recorded frames, oldest first.
+
+        :return: the path written
+        """
+        path = path or self.dump_path
+        if path is None:
+            raise ValueError('No dump path')
+        name = self.name.encode()
+        with open(path, 'wb') as file:
+            file.write(MAGIC + struct.pack('<H', len(name)) + name)
+            file.write(self._previous[:self._previous_length])
+            file.write(self._current[:self._pos])
+        return path
+
+
+def load(path):
+    """
+    Read a dump.
+
+    :return: (name, [(timestamp_ns, direction, data), ...]), direction is SENT or
+             RECEIVED, | TRUNCATED if data was cut to the buffer size
+    """
+    with open(path, 'rb') as file:
+        content = file.read()
+    if content[:len(MAGIC)] != MAGIC:
+        raise ValueError(f'{path} is not a PCIC recording')
+    pos = len(MAGIC)
+    name_length, = struct.unpack_from('<H', content, pos)
+    pos += 2
+    name = content[pos:pos + name_length].decode()
+    pos += name_length
+    frames = []
+    while pos < len(content):
+        timestamp, direction, length = FRAME.unpack_from(content, pos)
+        pos += FRAME.size
+        frames.append((timestamp, direction, content[pos:pos + length]))
+        pos += length
+    return name, frames
+
+
+class ReplayClient(PCICV3Client):
+    """
+    PCICV3Client reading the received frames of a recording instead of a socket,
+    so the answers go through the same frame parsing as on the line.
+    """
+    def __init__(self, frames) -> None:
+        inbound = b''.join(data for _, direction, data in frames if direction == RECEIVED)
+        self._stream = io.BytesIO(inbound)
+        self.pcicSocket = None
+        self.recorder = None
+        self.recv_counter = 0
+        self.debug = False
+        self.debugFull = False
+
+    def __del__(self):
+        pass
+
+    def recv(self, number_bytes):
+        data = self._stream.read(number_bytes)
+        if len(data) < number_bytes:
+            raise EOFError("End of recording")
+        self.recv_counter += number_bytes
+        return bytearray(data)
+
+    def recv_into(self, view, number_bytes):
+        view[:number_bytes] = self.recv(number_bytes)
+        return view[:number_bytes]
+
+    def close(self):
+        pass
+
+
+def replay(frames):
+    """
+    Pair every recorded command with its answer, parsed by ReplayClient.
+
+    :return: generator of (command, ticket, answer)
+    """
+    # Every command is answered in order. Answers whose command was already overwritten
+    # in the ring and truncated answers (with their command) are left out
+    pending = collections.deque()
+    commands = []
+    answers = []
+    for frame in frames:
+        direction = frame[1]
+        if direction & ~TRUNCATED == SENT:
+            pending.append(frame[2][20:-2])
+        elif pending:
+            command = pending.popleft()
+            if not direction & TRUNCATED:
+                commands.append(command)
+                answers.append(frame)
+    commands += pending
+    client = ReplayClient(answers)
+    for command in commands:
+        try:
+            ticket, answer = client.read_next_answer()
+        except EOFError:
+            return
+        yield command, ticket, answer
+
+
+def _parse(frames):
+    for command, ticket, answer in replay(frames):
+        if command in (b'T?', b'R?'):
+            decode_result(answer.decode('ascii'))
+        yield command, ticket, answer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m source.recorder', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dump')
+    parser.add_argument('--parse', action='store_true', help='replay the answers through the client parsing')
+    parser.add_argument('--profile', action='store_true', help='profile the replay')
+    args = parser.parse_args(argv)
+
+    name, frames = load(args.dump)
+    print(f'{args.dump}: {name} {len(frames)} frames')
+    if args.profile:
+        cProfile.runctx('list(_parse(frames))', globals(), {'frames': frames, '_parse': _parse}, sort='cumtime')
+    elif args.parse:
+        for command, ticket, answer in _parse(frames):
+            print(f'{bytes(ticket).decode()} {command.decode(errors="replace"):>4} -> {bytes(answer[:60])!r}')
+    else:
+        start = frames[0][0] if frames else 0
+        for timestamp, direction, data in frames:
+            arrow = '->' if direction & ~TRUNCATED == SENT else '<-'
+            cut = '+' if direction & TRUNCATED else ' '
+            print(f'{(timestamp - start) / 1e6:12.3f} ms {arrow} {len(data):8d}{cut} {bytes(data[:60])!r}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
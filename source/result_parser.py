@@ -0,0 +1,59 @@
+import re
+from collections import namedtuple
+import numpy as np
+
+
+# One row per detected instance: <index>#<x>#<y>#<rot>#<quality>
+INSTANCE_FIELDS = ('index', 'x', 'y', 'rot', 'quality')
+INSTANCE_DTYPE = np.dtype([('index', np.int32), ('x', np.float64), ('y', np.float64),
+                           ('rot', np.float64), ('quality', np.float64)])
+
+ParsedResult = namedtuple('ParsedResult', ['result', 'match', 'count', 'instances',
+                                           'model_info', 'image_info'])
+
+_FRAME = re.compile(r'start(?P<result>[^#]*)#(?P<match>[^#]*)#(?P<count>\d+)(?P<rest>.*)stop', re.S)
+
+
+def parse_result(trama):
+    """
+    Parse a complete T?/R? answer.
+
+    Syntax:
+        <start><result><sc><match><sc><instances>
+        [<sc><index><sc><x><sc><y><sc><rot><sc><quality>] * <instances>
+        [<sc><model info>][<sc><image info>]<stop>
+
+    The numeric fields of all the instances are converted by numpy at once, there
+    is no Python loop per instance (only one array copy per column).
+
+    :param trama: answer of the device as string
+    :return: ParsedResult with the instances as a structured array (INSTANCE_DTYPE),
+             model_info/image_info are the raw segments or None, or "!"
+    :raises ValueError: if the answer does not follow the syntax
+    """
+    if trama == '!':
+        return trama
+    frame = _FRAME.fullmatch(trama)
+    if frame is None:
+        raise ValueError(f'Invalid result trama: {trama[:64]!r}')
+    count = int(frame.group('count'))
+    rest = frame.group('rest')
+    fields = rest[1:].split('#') if rest else []
+
+    size = count * len(INSTANCE_FIELDS)
+    if len(fields) < size:
+        raise ValueError(f'Expected {count} instances, got {len(fields) // len(INSTANCE_FIELDS)}')
+    values = np.array(fields[:size], dtype=np.float64).reshape(count, len(INSTANCE_FIELDS))
+    instances = np.empty(count, INSTANCE_DTYPE)
+    for column, name in enumerate(INSTANCE_FIELDS):
+        instances[name] = values[:, column]
+
+    extra = fields[size:]
+    return ParsedResult(
+        result=frame.group('result'),
+        match=float(frame.group('match')),
+        count=count,
+        instances=instances,
+        model_info=extra[0] if len(extra) > 0 else None,
+        image_info=extra[1] if len(extra) > 1 else None,
+    )
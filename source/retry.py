@@ -0,0 +1,193 @@
+import asyncio
+import socket
+import time
+
+
+class RetryExhausted(Exception):
+    """
+    Raised by RetryPolicy.run when no attempt succeeded within the tries/budget.
+
+    :param kind: classification of the last failure ('busy', 'timeout' or 'fail')
+    :param last: last returned value (None if the last attempt raised)
+    """
+    def __init__(self, key, kind, last=None) -> None:
+        super(RetryExhausted, self).__init__(f"<{key}> gave up after '{kind}'")
+        self.key = key
+        self.kind = kind
+        self.last = last
+
+
+class RetryPolicy(object):
+    """
+    Retry policy shared by the PCIC and XML-RPC detection paths.
+
+    An attempt is retried only while tries are left, its failure kind is in
+    `retry_on` and the remaining budget can still fit another attempt (estimated
+    from the duration of the previous one). Failures are classified as:
+        - busy      the device answered '!'
+        - timeout   socket timeout
+        - fail      the evaluation returned a FAIL result / ValueError
+
+    Parameters
+    ----------
+    tries:
+        maximum number of attempts per call.
+    budget:
+        time in seconds one call may take (e.g. the line takt time), None for no limit.
+    retry_on:
+        failure kinds that are worth retrying.
+    backoff:
+        pause in seconds between attempts.
+    """
+    KINDS = ('busy', 'timeout', 'fail')
+
+    def __init__(self, tries=3, budget=None, retry_on=KINDS, backoff=0.0) -> None:
+        self.tries = tries
+        self.budget = budget
+        self.retry_on = tuple(retry_on)
+        self.backoff = backoff
+        self.stats = {}
+
+    @staticmethod
+    def classify(outcome):
+        """
+        Default classification of a returned value.
+
+        :return: None if the outcome is a success, the failure kind otherwise
+        """
+        if isinstance(outcome, (str, bytes)):
+            return 'busy' if outcome in ('!', b'!') else None
+        if isinstance(outcome, dict):
+            for value in outcome.values():
+                if isinstance(value, (str, bytes)) and value in ('!', b'!'):
+                    return 'busy'
+            if str(outcome.get('result', '')).endswith('FAIL'):
+                return 'fail'
+        return None
+
+    @staticmethod
+    def classify_error(error):
+        """
+        Classification of a raised exception, None if it must not be handled here.
+        """
+        if isinstance(error, (socket.timeout, TimeoutError, asyncio.TimeoutError)):
+            return 'timeout'
+        if isinstance(error, ValueError):
+            return 'fail'
+        return None
+
+    def get_stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = {
+                'calls': 0,
+                'attempts': 0,
+                'deadline_misses': 0,
+                'busy': 0,
+                'timeout': 0,
+                'fail': 0,
+            }
+        return self.stats[key]
+
+    def deadline(self, start=None):
+        """
+        Absolute deadline (time.monotonic) for a call started at `start`.
+        """
+        if self.budget is None:
+            return None
+        if start is None:
+            start = time.monotonic()
+        return start + self.budget
+
+    def _can_retry(self, attempt, tries, kind, duration, deadline):
+        """
+        :return: True to retry, False to give up, None to give up because of the deadline
+        """
+        if kind not in self.retry_on or attempt >= tries:
+            return False
+        if deadline is not None and time.monotonic() + duration + self.backoff > deadline:
+            return None
+        return True
+
+    def run(self, key, func, *args, classify=None, deadline=None, tries=None, **kwargs):
+        """
+        Call func(*args, **kwargs) until it succeeds or the policy gives up.
+
+        :param key: camera identifier the attempts are recorded for
+        :param classify: function(outcome) -> failure kind or None, defaults to self.classify
+        :param deadline: absolute time.monotonic() deadline, overrides the budget
+                         (used to share one cycle deadline between several cameras)
+        :param tries: overrides self.tries for this call
+        :return: the first successful outcome
+        :raises RetryExhausted: when no attempt succeeded
+        """
+        classify = classify or self.classify
+        stats = self.get_stats(key)
+        stats['calls'] += 1
+        if deadline is None:
+            deadline = self.deadline()
+        if tries is None:
+            tries = self.tries
+
+        attempt = 0
+        while True:
+            attempt += 1
+            stats['attempts'] += 1
+            start = time.monotonic()
+            outcome = None
+            try:
+                outcome = func(*args, **kwargs)
+                kind = classify(outcome)
+            except Exception as e:
+                kind = self.classify_error(e)
+                if kind is None:
+                    raise
+            if kind is None:
+                return outcome
+            stats[kind] += 1
+            retry = self._can_retry(attempt, tries, kind, time.monotonic() - start, deadline)
+            if not retry:
+                if retry is None or (deadline is not None and time.monotonic() > deadline):
+                    stats['deadline_misses'] += 1
+                raise RetryExhausted(key, kind, outcome)
+            if self.backoff:
+                time.sleep(self.backoff)
+
+    async def run_async(self, key, func, *args, classify=None, deadline=None, tries=None, **kwargs):
+        """
+        Same as `run` for a coroutine function, the backoff does not block the event loop.
+        An attempt still running at the deadline is cancelled and counts as a timeout.
+        """
+        classify = classify or self.classify
+        stats = self.get_stats(key)
+        stats['calls'] += 1
+        if deadline is None:
+            deadline = self.deadline()
+        if tries is None:
+            tries = self.tries
+
+        attempt = 0
+        while True:
+            attempt += 1
+            stats['attempts'] += 1
+            start = time.monotonic()
+            outcome = None
+            try:
+                if deadline is None:
+                    outcome = await func(*args, **kwargs)
+                else:
+                    outcome = await asyncio.wait_for(func(*args, **kwargs), deadline - start)
+                kind = classify(outcome)
+            except Exception as e:
+                kind = self.classify_error(e)
+                if kind is None:
+                    raise
+            if kind is None:
+                return outcome
+            stats[kind] += 1
+            retry = self._can_retry(attempt, tries, kind, time.monotonic() - start, deadline)
+            if not retry:
+                if retry is None or (deadline is not None and time.monotonic() > deadline):
+                    stats['deadline_misses'] += 1
+                raise RetryExhausted(key, kind, outcome)
+            if self.backoff:
+                await asyncio.sleep(self.backoff)
@@ -0,0 +1,358 @@
+import asyncio
+import time
+import xmlrpc.client
+from ..retry import RetryPolicy, RetryExhausted
+from .metadata_cache import MetadataCache
+from .rpc_client import decode_detection
+
+
+async def get_ip_address_async(reference_ip, reference_port):
+    """
+    Local address used to reach reference_ip, see rpc_client.get_ip_address.
+    """
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        asyncio.DatagramProtocol, remote_addr=(reference_ip, reference_port))
+    try:
+        return transport.get_extra_info('sockname')[0]
+    finally:
+        transport.close()
+
+
+class AsyncXmlRpcTransport(object):
+    """
+    XML-RPC over a non-blocking HTTP/1.1 connection (asyncio streams).
+
+    The connection is kept open between calls when the server allows it and the
+    calls of one transport are serialised. A call that times out or is cancelled
+    closes the connection, the next call opens a new one.
+
+    Parameters
+    ----------
+    host, port:
+        address of the XML-RPC server.
+    path:
+        HTTP path of the XML-RPC endpoint.
+    timeout:
+        default seconds per call (connection, request and answer), None for no limit.
+    """
+    def __init__(self, host, port, path='/RPC2', timeout=5.0) -> None:
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.calls = 0
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def call(self, method, *params, timeout=None):
+        """
+        Call a remote method.
+
+        :param timeout: overrides self.timeout for this call
+        :return: the value returned by the method
+        :raises asyncio.TimeoutError: if the call took longer than timeout
+        :raises xmlrpc.client.Fault: if the server answered a fault
+        """
+        body = xmlrpc.client.dumps(params, method, allow_none=True).encode()
+        async with self._lock:
+            self.calls += 1
+            try:
+                answer = await asyncio.wait_for(self._exchange(body),
+                                                self.timeout if timeout is None else timeout)
+            except BaseException:
+                # Timeout, cancellation or broken connection: the stream state is unknown
+                self.close()
+                raise
+        return xmlrpc.client.loads(answer, use_builtin_types=True)[0][0]
+
+    async def _exchange(self, body):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._writer.write(b'POST %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Type: text/xml\r\n'
+                           b'Content-Length: %d\r\n\r\n'
+                           % (self.path.encode(), self.host.encode(), self.port, len(body)) + body)
+        await self._writer.drain()
+
+        head = await self._reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        version, status, reason = (lines[0].split(' ', 2) + ['', ''])[:3]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'content-length' in headers:
+            answer = await self._reader.readexactly(int(headers['content-length']))
+            keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        else:
+            answer = await self._reader.read()
+            keep_alive = False
+        if not keep_alive:
+            self.close()
+        if status != '200':
+            code = int(status) if status.isdigit() else 0
+            raise xmlrpc.client.ProtocolError(f'{self.host}:{self.port}{self.path}', code,
+                                              reason or lines[0], headers)
+        return answer
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+
+class AsyncXmlRpcCameraProxy(object):
+    """
+    asyncio counterpart of XmlRpcCameraProxy with the same connect / init_config /
+    detection flow. Every call has its own timeout and can be cancelled, no thread
+    and no global socket timeout is involved.
+
+    proxy = AsyncXmlRpcCameraProxy('192.168.0.49', 8080)
+    await proxy.connect("3.5.0061")
+    await proxy.init_config()
+    result = await proxy.execute_detection()
+
+    Parameters
+    ----------
+    ip, port:
+        address of the sensor.
+    timeout:
+        default seconds per XML-RPC call.
+    cache:
+        optional metadata_cache.MetadataCache, see XmlRpcCameraProxy.
+    """
+    def __init__(self, ip, port, timeout=5.0, cache=None) -> None:
+        self.cache = cache
+        self.metadata = None
+        # Local address used to reach the sensor, resolved (or read from the cache) by connect
+        self.user_ip = None
+        self.url = f"http://{ip}:{port}/RPC2"
+        self.ip = ip
+        self.transport = AsyncXmlRpcTransport(ip, port, timeout=timeout)
+        self.test_config = None
+        self.retry_policy = RetryPolicy(tries=3)
+        # Print every detection step
+        self.debug = False
+
+    async def call(self, method, *params, timeout=None):
+        return await self.transport.call(method, *params, timeout=timeout)
+
+    async def connect(self, platform):
+        address = (self.transport.host, self.transport.port)
+        if self.user_ip is None and self.cache is not None:
+            self.user_ip = self.cache.route(address[0])
+        if self.user_ip is None:
+            self.user_ip = await get_ip_address_async(*address)
+            if self.cache is not None:
+                self.cache.set_route(address[0], self.user_ip)
+        resp = await self.call('xmlConnect', self.user_ip, platform)
+        if resp[0] != 0 and self.cache is not None:
+            # The cached route may be stale (other network on the host)
+            user_ip = await get_ip_address_async(*address)
+            if user_ip != self.user_ip:
+                self.user_ip = user_ip
+                self.cache.set_route(address[0], user_ip)
+                resp = await self.call('xmlConnect', self.user_ip, platform)
+        if resp[0] != 0:
+            print(f"Error connecting to {self.user_ip}: {resp[0]}")
+            return resp
+        print(f"Connected: {self.user_ip} -> {self.url}")
+        self.id = resp[1]
+        self.session = resp[2]
+        self.model = resp[3]
+        self.firmware_version = resp[4]
+        # Always read: the MAC tells which cache entry belongs to this device
+        network_params = await self.get_network_parameters()
+        if self.cache is not None and network_params:
+            self.metadata = self.cache.lookup(network_params, self.firmware_version)
+        return resp
+
+    async def disconnect(self):
+        if self.test_config is not None and self.test_config[0] == 0:
+            self.test_config = await self.call('xmlTestConfig', 0)
+        resp = await self.call('xmlDisconnect', self.user_ip)
+        if resp[0] == 0:
+            print(f"Disconnected from {self.ip}")
+        else:
+            print(f"Error disconnecting from {self.ip}")
+        self.transport.close()
+        return resp
+
+    async def get_compaitble_versions(self):
+        if self.metadata is not None and self.metadata['compatible_versions'] is not None:
+            resp = self.metadata['compatible_versions']
+        else:
+            resp = await self.call('xmlGetCompatibleCPVersions')
+            if self.metadata is not None and resp[0] == 0:
+                self.cache.update(self.metadata, compatible_versions=list(resp))
+        if resp[0] == 0:
+            self.num_versions = resp[1]
+            self.compatible_versions = resp[2:]
+        else:
+            print(f"Error getting compatible versions: {resp[0]}")
+        return resp
+
+    async def get_network_parameters(self):
+        network_params = {}
+        resp = await self.call('xmlGetNetworkParameters')
+        if resp[0] == 0:
+            network_params['ip'] = resp[2]
+            network_params['subnet'] = resp[3]
+            network_params['gateway'] = resp[4]
+            network_params['http_port'] = resp[5]
+            network_params['udp_port'] = resp[6]
+            network_params['mac'] = resp[7]
+            self.set_network_parameters(network_params)
+        else:
+            print(f"Error getting network parameters: {resp[0]}")
+        return network_params
+
+    def set_network_parameters(self, network_params):
+        self.ip = network_params['ip']
+        self.subnet = network_params['subnet']
+        self.gateway = network_params['gateway']
+        self.http_port = network_params['http_port']
+        self.udp_port = network_params['udp_port']
+        self.mac = network_params['mac']
+
+    async def init_config(self):
+        if self.metadata is not None and self.metadata['config_list'] is not None:
+            resp = self.metadata['config_list']
+        else:
+            resp = await self.call('xmlGetConfigList')
+            if self.metadata is not None and resp[0] == 0:
+                self.cache.update(self.metadata, config_list=list(resp))
+        if resp[0] == 0:
+            self.available_configs = resp[1]
+            self.size_configs = resp[3]
+            self.config_id = resp[4]
+        else:
+            print(f"Error getting configuration list: {resp[0]}")
+        self.open_config = await self.call('xmlOpenConfiguration', self.config_id, 0)
+        self.test_config = await self.call('xmlTestConfig', 1)
+        if self.debug:
+            print(f'<{self.ip}> Init config: {self.open_config} {self.test_config}')
+        return self.test_config
+
+    async def detection(self, poll_interval=0.01):
+        """
+        One trigger and its result, see XmlRpcCameraProxy.detection.
+
+        :param poll_interval: seconds between xmlPollResults calls
+        :raises asyncio.TimeoutError: if no result came within the transport timeout
+        """
+        result = {}
+        resume_results = await self.call('xmlResumeResults')
+        # Host time of the trigger, see source.correlation
+        result['trigger_ts'] = time.monotonic()
+        trigger = await self.call('xmlExecuteTrigger')
+        poll_results = [0, 0]
+        timeout = self.transport.timeout
+        poll_deadline = None if timeout is None else time.monotonic() + timeout
+        while poll_results[1] == 0:
+            poll_results = await self.call('xmlPollResults')
+            if poll_results[1] == 0:
+                if poll_deadline is not None and time.monotonic() > poll_deadline:
+                    raise asyncio.TimeoutError(f'<{self.url}> No result after {timeout} s')
+                await asyncio.sleep(poll_interval)
+        config_results = await self.call('xmlGetConfigRunResults')
+        if self.debug:
+            print(f'<{self.ip}> Execute detection: Res:{resume_results} Trigger: {trigger}')
+            print(f'\tPoll: {poll_results[1]} -> <{self.ip}> Conf Res: {config_results}')
+        if config_results[1] == 0:
+            raise ValueError(f"Error executing detection: {config_results[1]}")
+        self.last_detection = await self.call('xmlGetConfigInstances', 1)
+        return decode_detection(self.last_detection, result)
+
+    async def execute_detection(self, tries=None, deadline=None):
+        try:
+            result = await self.retry_policy.run_async(self.url, self.detection, tries=tries, deadline=deadline)
+            if self.debug:
+                print(result)
+            return result
+        except RetryExhausted as e:
+            print(f"<{self.url}> {e.kind}, no tries or time left")
+        return {'error': 1}
+
+
+class AsyncXmlRpcProxyManager(object):
+    """
+    asyncio counterpart of XmlRpcProxyManager, one event loop drives all the cameras.
+
+    Parameters
+    ----------
+    ip_list, port, platform, budget, cache:
+        see XmlRpcProxyManager.
+    timeout:
+        default seconds per XML-RPC call.
+    """
+    def __init__(self, ip_list, port, platform="3.5.0061", budget=None, cache=None, timeout=5.0) -> None:
+        self.platform = platform
+        if isinstance(cache, str):
+            cache = MetadataCache(cache)
+        self.cache = cache
+        self.proxies = [AsyncXmlRpcCameraProxy(ip, port, timeout, cache) for ip in ip_list]
+        self.retry_policy = RetryPolicy(tries=3, budget=budget)
+        for proxy in self.proxies:
+            proxy.retry_policy = self.retry_policy
+        # Optional source.correlation.FrameCorrelator keyed by proxy url
+        self.correlator = None
+
+    def __getitem__(self, index):
+        return self.proxies[index]
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def __iter__(self):
+        return iter(self.proxies)
+
+    async def _gather(self, name, *args):
+        """
+        Run a coroutine method on every proxy at once, exceptions are returned in place
+        of the result of their camera.
+        """
+        return await asyncio.gather(*(getattr(proxy, name)(*args) for proxy in self.proxies),
+                                    return_exceptions=True)
+
+    async def connect(self):
+        results = await self._gather('connect', self.platform)
+        if self.cache is not None:
+            self.cache.save()
+        return results
+
+    async def disconnect(self):
+        return await self._gather('disconnect')
+
+    async def get_compaitble_versions(self):
+        return await self._gather('get_compaitble_versions')
+
+    async def init_config(self):
+        results = await self._gather('init_config')
+        if self.cache is not None:
+            self.cache.save()
+        return results
+
+    async def execute_detection(self, tries=None, budget=None):
+        """
+        Execute the detection on every camera, all of them share the same cycle deadline
+        (budget in seconds, defaults to the budget of the retry policy). tries defaults
+        to the tries of the retry policy
+        """
+        if budget is None:
+            deadline = self.retry_policy.deadline()
+        else:
+            deadline = time.monotonic() + budget
+        results = []
+        for result in await self._gather('execute_detection', tries, deadline):
+            if isinstance(result, BaseException):
+                print(f"Error: {result!r}")
+                result = None
+            results.append(result)
+        if self.correlator is not None:
+            for proxy, result in zip(self.proxies, results):
+                if result is not None and 'trigger_ts' in result:
+                    self.correlator.add(proxy.url, result, result['trigger_ts'])
+        return results
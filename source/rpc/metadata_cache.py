@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+
+
+class MetadataCache(object):
+    """
+    On-disk cache of the XML-RPC metadata of the sensors.
+
+    Entries are keyed by MAC and firmware version and hold the network parameters,
+    the compatible PC software versions and the configuration list. The network
+    parameters (which hold the MAC) are read from the device on every connect and
+    select the entry, so a sensor swapped for an identical one (same model and
+    firmware, other MAC) never gets the configuration list of the previous one.
+    An entry is started again when the network parameters of its device changed.
+    The local address used to reach each sensor (get_ip_address) is kept by camera
+    address as well, the proxies resolve it again when xmlConnect refuses it.
+
+    Only reads are cached, xmlOpenConfiguration and xmlTestConfig change the state
+    of the device and are always sent.
+
+    cache = MetadataCache('xmlrpc_cache.json')
+    manager = XmlRpcProxyManager(ip_list, 8080, cache=cache)
+
+    Parameters
+    ----------
+    path:
+        JSON file, created by `save` if it does not exist.
+    """
+    VERSION = 2
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._data = {'version': self.VERSION, 'devices': {}, 'routes': {}}
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            if data.get('version') == self.VERSION:
+                self._data = data
+                self._data.setdefault('routes', {})
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def key(mac, firmware):
+        return f'{mac}|{firmware}'
+
+    def route(self, ip):
+        """
+        :return: the local address last used to reach ip, None if unknown
+        """
+        return self._data['routes'].get(ip)
+
+    def set_route(self, ip, user_ip):
+        with self._lock:
+            if self._data['routes'].get(ip) != user_ip:
+                self._data['routes'][ip] = user_ip
+                self._dirty = True
+
+    def lookup(self, network, firmware):
+        """
+        Entry of the device with the MAC of network and firmware, created empty if the
+        device is unknown or its network parameters changed.
+
+        :param network: network parameters read from the device (get_network_parameters)
+        :return: {'network': {...}, 'compatible_versions': [...] or None,
+                 'config_list': [...] or None}, fill it with `update`
+        """
+        key = self.key(network['mac'], firmware)
+        with self._lock:
+            entry = self._data['devices'].get(key)
+            if entry is None or entry['network'] != network:
+                self.misses += 1
+                entry = {'network': dict(network), 'compatible_versions': None, 'config_list': None}
+                self._data['devices'][key] = entry
+                self._dirty = True
+            else:
+                self.hits += 1
+            return entry
+
+    def update(self, entry, **values):
+        with self._lock:
+            entry.update(values)
+            self._dirty = True
+
+    def save(self):
+        """
+        Write the cache if it changed, through a temporary file so a crash can not
+        leave a truncated cache.
+        """
+        with self._lock:
+            if not self._dirty:
+                return False
+            temp = f'{self.path}.tmp'
+            with open(temp, 'w') as file:
+                json.dump(self._data, file, indent=1)
+            os.replace(temp, self.path)
+            self._dirty = False
+            return True
@@ -1,6 +1,9 @@
 import xmlrpc.client
 import concurrent.futures
 import socket
+import time
+from ..retry import RetryPolicy, RetryExhausted
+from .metadata_cache import MetadataCache
 
 
 # This function will return the IP address of the device even when it is conncted to a VPN
@@ -11,15 +14,46 @@ def get_ip_address(refference_ip, refference_port):
     s.close()
     return ip_address
 
+def decode_detection(instances, result=None):
+    """
+    Decode an xmlGetConfigInstances answer into the detection result.
+
+    :raises ValueError: if the device returned an error
+    """
+    if instances[0] != 0:
+        raise ValueError(f"Error getting results: {instances[0]}")
+    # type result [0, 1, [1, 'Ak0xAw__', 260.440002, 0.959605, 335.676086, 87.168205, 0.908069, 17, 627, 455, 57, 79], 322.972]
+    result = {} if result is None else result
+    result['result'] = instances[2][0]
+    result['id_app'] = instances[2][1]
+    result['cal_time'] = instances[2][2]
+    result['orientation'] = instances[2][3]
+    result['x'] = instances[2][4]
+    result['y'] = instances[2][5]
+    result['confidence'] = instances[2][6]
+    result['error'] = 0
+    return result
+
+
 class XmlRpcCameraProxy:
-    def __init__(self, ip:str, port:int, timeout:float=30):
-        self.user_ip = get_ip_address(ip, port)
-        print(self.user_ip)
+    def __init__(self, ip:str, port:int, timeout:float=30, cache=None):
+        # Optional metadata_cache.MetadataCache, skips the version and configuration list reads
+        self.cache = cache
+        self.metadata = None
+        self.address = (ip, port)
+        self.user_ip = cache.route(ip) if cache is not None else None
+        if self.user_ip is None:
+            self.user_ip = get_ip_address(ip, port)
+            if cache is not None:
+                cache.set_route(ip, self.user_ip)
         self.url = f"http://{ip}:{port}/RPC2"
         self.stream_url = f"udp://{ip}:50002"
         socket.setdefaulttimeout(timeout)
         self.proxy = xmlrpc.client.ServerProxy(self.url)
         self.test_config = [0]
+        self.retry_policy = RetryPolicy(tries=3)
+        # Print every detection step
+        self.debug = False
 
     def __getattr__(self, name):
         """
@@ -43,24 +77,33 @@ class XmlRpcCameraProxy:
 
     def connect(self, platform):
         resp = self.proxy.xmlConnect(self.user_ip, platform)
+        if resp[0] != 0 and self.cache is not None:
+            # The cached route may be stale (other network on the host)
+            user_ip = get_ip_address(*self.address)
+            if user_ip != self.user_ip:
+                self.user_ip = user_ip
+                self.cache.set_route(self.address[0], user_ip)
+                resp = self.proxy.xmlConnect(self.user_ip, platform)
         if resp[0] == 0:
             print(f"Connected: {self.user_ip} -> {self.url}")
             self.id = resp[1]
             self.session = resp[2]
             self.model = resp[3]
             self.firmware_version = resp[4]
+            # Always read: the MAC tells which cache entry belongs to this device
             network_params = self.get_network_parameters()
-            self.ip = network_params['ip']
-            self.subnet = network_params['subnet']
-            self.gateway = network_params['gateway']
-            self.http_port = network_params['http_port']
-            self.udp_port = network_params['udp_port']
-            self.mac = network_params['mac']
+            if self.cache is not None and network_params:
+                self.metadata = self.cache.lookup(network_params, self.firmware_version)
         else:
             print(f"Error connecting to {self.user_ip}: {resp[0]}")
 
     def get_compaitble_versions(self):
-        resp = self.proxy.xmlGetCompatibleCPVersions()
+        if self.metadata is not None and self.metadata['compatible_versions'] is not None:
+            resp = self.metadata['compatible_versions']
+        else:
+            resp = self.proxy.xmlGetCompatibleCPVersions()
+            if self.metadata is not None and resp[0] == 0:
+                self.cache.update(self.metadata, compatible_versions=list(resp))
         if resp[0] == 0:
             self.num_versions = resp[1]
             self.compatible_versions = resp[2:]
@@ -84,20 +127,28 @@ class XmlRpcCameraProxy:
             # else:
             #     network_params['pcic_port'] = None
 
-            self.ip = network_params['ip']
-            self.subnet = network_params['subnet']
-            self.gateway = network_params['gateway']
-            self.http_port = network_params['http_port']
-            self.udp_port = network_params['udp_port']
-            self.mac = network_params['mac']
-            # self.pcic_port = network_params['pcic_port']
+            self.set_network_parameters(network_params)
         else:
             print(f"Error getting network parameters: {resp[0]}")  
         
         return network_params
 
+    def set_network_parameters(self, network_params):
+        self.ip = network_params['ip']
+        self.subnet = network_params['subnet']
+        self.gateway = network_params['gateway']
+        self.http_port = network_params['http_port']
+        self.udp_port = network_params['udp_port']
+        self.mac = network_params['mac']
+        # self.pcic_port = network_params['pcic_port']
+
     def init_config(self):
-        resp = self.proxy.xmlGetConfigList()
+        if self.metadata is not None and self.metadata['config_list'] is not None:
+            resp = self.metadata['config_list']
+        else:
+            resp = self.proxy.xmlGetConfigList()
+            if self.metadata is not None and resp[0] == 0:
+                self.cache.update(self.metadata, config_list=list(resp))
         if resp[0] == 0:
             self.available_configs = resp[1]
             self.size_configs = resp[3]
@@ -112,49 +163,32 @@ class XmlRpcCameraProxy:
 
     def detection(self):
         result = {}
-        print(f'<{self.ip}> Execute detection: ', end='')
         resume_results = self.proxy.xmlResumeResults()
-        print(f'Res:{resume_results}', end='')
+        # Host time of the trigger, see source.correlation
+        result['trigger_ts'] = time.monotonic()
         trigger = self.proxy.xmlExecuteTrigger()
-        print(f'Trigger: {trigger}')
         poll_results = [0,0]
         while poll_results[1] == 0:
             poll_results = self.proxy.xmlPollResults()
-        print(f'\tPoll: {poll_results[1]}', end=' -> ')
         config_results = self.proxy.xmlGetConfigRunResults()
-        print(f'<{self.ip}> Conf Res: {config_results}')
+        if self.debug:
+            print(f'<{self.ip}> Execute detection: Res:{resume_results} Trigger: {trigger}')
+            print(f'\tPoll: {poll_results[1]} -> <{self.ip}> Conf Res: {config_results}')
         if config_results[1] == 0:
             raise ValueError(f"Error executing detection: {config_results[1]}")
         self.last_detection = self.proxy.xmlGetConfigInstances(1)
-        if self.last_detection[0] == 0:
-            # type result [0, 1, [1, 'Ak0xAw__', 260.440002, 0.959605, 335.676086, 87.168205, 0.908069, 17, 627, 455, 57, 79], 322.972]
-            result['result'] = self.last_detection[2][0]
-            result['id_app'] = self.last_detection[2][1]
-            result['cal_time'] = self.last_detection[2][2]
-            result['orientation'] = self.last_detection[2][3]
-            result['x'] = self.last_detection[2][4]
-            result['y'] = self.last_detection[2][5]
-            result['confidence'] = self.last_detection[2][6]
-            result['error'] = 0
-            return result
-        else:
-            raise ValueError(f"Error getting results: {self.last_detection[0]}")
+        return decode_detection(self.last_detection, result)
 
 
-    def execute_detection(self, tries=3):
-        while tries > 0:
-            try:
-                result = self.detection()
+    def execute_detection(self, tries=None, deadline=None):
+        try:
+            result = self.retry_policy.run(self.url, self.detection, tries=tries, deadline=deadline)
+            if self.debug:
                 print(result)
-                return result
-            except socket.timeout:
-                tries -= 1
-                print("Timeout, trying again...")
-            except ValueError as e:
-                print(e)
-                tries -= 1
-                print("ValueError, trying again...")
-        
+            return result
+        except RetryExhausted as e:
+            print(f"<{self.url}> {e.kind}, no tries or time left")
+
         result = {}
         result['error'] = 1
         print(result)
@@ -162,9 +196,19 @@ class XmlRpcCameraProxy:
         
 
 class XmlRpcProxyManager:
-    def __init__(self, ip_list, port, platform="3.5.0061"):
+    def __init__(self, ip_list, port, platform="3.5.0061", budget=None, cache=None):
         self.platform = platform
-        self.proxies = [XmlRpcCameraProxy(ip, port) for ip in ip_list]
+        # Optional MetadataCache (or its path) shared by the proxies, saved after connect/init_config
+        if isinstance(cache, str):
+            cache = MetadataCache(cache)
+        self.cache = cache
+        self.proxies = [XmlRpcCameraProxy(ip, port, cache=cache) for ip in ip_list]
+        # One policy for the whole line: attempts and deadline misses are recorded per camera url
+        self.retry_policy = RetryPolicy(tries=3, budget=budget)
+        for proxy in self.proxies:
+            proxy.retry_policy = self.retry_policy
+        # Optional source.correlation.FrameCorrelator keyed by proxy url
+        self.correlator = None
 
     def __getitem__(self, index):
         """
@@ -192,7 +236,9 @@ class XmlRpcProxyManager:
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.proxies)) as executor:
             futures = [executor.submit(proxy.connect, self.platform) for proxy in self.proxies]
             results = [future.result() for future in futures]
-            print(results)    
+            print(results)
+        if self.cache is not None:
+            self.cache.save()
     
     def disconnect(self):
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.proxies)) as executor:
@@ -208,11 +254,22 @@ class XmlRpcProxyManager:
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.proxies)) as executor:
             futures = [executor.submit(proxy.init_config) for proxy in self.proxies]
             results = [future.result() for future in futures]
+        if self.cache is not None:
+            self.cache.save()
         return results
 
-    def execute_detection(self, tries=3):
+    def execute_detection(self, tries=None, budget=None):
+        """
+        Execute the detection on every camera, all of them share the same cycle deadline
+        (budget in seconds, defaults to the budget of the retry policy). tries defaults
+        to the tries of the retry policy
+        """
+        if budget is None:
+            deadline = self.retry_policy.deadline()
+        else:
+            deadline = time.monotonic() + budget
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.proxies)) as executor:
-            futures = [executor.submit(proxy.execute_detection) for proxy in self.proxies]
+            futures = [executor.submit(proxy.execute_detection, tries, deadline) for proxy in self.proxies]
             print(futures)
             results = []
             for future in futures:
@@ -223,6 +280,10 @@ class XmlRpcProxyManager:
                     result = None
                     print(f"Error: {e}")
                 results.append(result)
+        if self.correlator is not None:
+            for proxy, result in zip(self.proxies, results):
+                if result is not None and 'trigger_ts' in result:
+                    self.correlator.add(proxy.url, result, result['trigger_ts'])
         return results
     
 
@@ -0,0 +1,166 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+
+# Priority classes, lower runs first. Evaluations and images are one FIFO class:
+# the device only keeps the image of its last evaluation, so an I?/F? must never
+# be overtaken by a later T?
+EVALUATION = 0
+HEALTH = 1
+
+DEFAULT_HEALTH_QUERIES = {
+    'statistics': ('request_statistics', 1.0),
+    'error': ('request_error_code_decoded', 1.0),
+    'device_info': ('request_device_info_decoded', 30.0),
+}
+
+
+class CommandScheduler(object):
+    """
+    Serialises all the commands of one O2D22xPCICDevice through a single worker thread.
+
+    Evaluations and images (EVALUATION) run in submission order, so an image is
+    always fetched before the next trigger. Commands submitted as HEALTH wait until
+    no EVALUATION command is queued. The periodic health queries (s?, E?, D?) only
+    run when the queue is empty, each one at most once every `interval` seconds, and
+    their answers are kept in a snapshot that `health` returns without touching the
+    socket. Either way a health query can only delay an evaluation by the command
+    already on the wire.
+
+    Once the scheduler is running, every command of the device must go through it.
+
+    Parameters
+    ----------
+    device:
+        O2D22xPCICDevice owned by the scheduler.
+    health_queries:
+        {name: (device method name, interval in seconds)}, None for DEFAULT_HEALTH_QUERIES.
+    """
+    def __init__(self, device, health_queries=None) -> None:
+        self.device = device
+        self._queue = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._health = {}
+        self._snapshot = {}
+        self._running = True
+        if health_queries is None:
+            health_queries = DEFAULT_HEALTH_QUERIES
+        for name, (method, interval) in health_queries.items():
+            self.add_health_query(name, method, interval)
+        self._thread = threading.Thread(target=self._work, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, method, *args, priority=EVALUATION, **kwargs):
+        """
+        Queue a command.
+
+        :param method: name of a device method (e.g. 'evaluate_image_decoded') or a
+                       callable that receives the device
+        :param priority: EVALUATION (evaluations and images) or HEALTH (runs when no
+                         EVALUATION command is waiting)
+        :return: concurrent.futures.Future with the answer
+        """
+        future = Future()
+        with self._cond:
+            if not self._running:
+                raise RuntimeError('Scheduler closed')
+            heapq.heappush(self._queue, (priority, next(self._order), future, method, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def call(self, method, *args, priority=EVALUATION, timeout=None, **kwargs):
+        """
+        Queue a command and wait for its answer.
+        """
+        return self.submit(method, *args, priority=priority, **kwargs).result(timeout)
+
+    def add_health_query(self, name, method, interval):
+        """
+        Poll a device method in the idle gaps, at most once every `interval` seconds.
+        """
+        with self._cond:
+            self._health[name] = [method, interval, time.monotonic()]
+            self._cond.notify()
+
+    def remove_health_query(self, name):
+        with self._cond:
+            self._health.pop(name, None)
+            self._snapshot.pop(name, None)
+
+    def health(self, name=None):
+        """
+        Last health answers, without sending anything to the device.
+
+        :return: {name: {'value': answer, 'timestamp': time.time(), 'error': exception or None}}
+                 or the entry of `name` (None if not polled yet)
+        """
+        with self._cond:
+            if name is not None:
+                return self._snapshot.get(name)
+            return dict(self._snapshot)
+
+    def close(self):
+        """
+        Run the commands already queued and stop the worker.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._queue:
+                    _, _, future, method, args, kwargs = heapq.heappop(self._queue)
+                    return future, method, args, kwargs
+                if not self._running:
+                    return None
+                now = time.monotonic()
+                wait = None
+                for name, query in self._health.items():
+                    method, interval, due = query
+                    if due <= now:
+                        query[2] = now + interval
+                        return name, method, (), {}
+                    if wait is None or due - now < wait:
+                        wait = due - now
+                self._cond.wait(wait)
+
+    def _execute(self, method, args, kwargs):
+        if callable(method):
+            return method(self.device, *args, **kwargs)
+        return getattr(self.device, method)(*args, **kwargs)
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            target, method, args, kwargs = job
+            if isinstance(target, Future):
+                if not target.set_running_or_notify_cancel():
+                    continue
+                try:
+                    target.set_result(self._execute(method, args, kwargs))
+                except Exception as e:
+                    target.set_exception(e)
+                continue
+            entry = {'value': None, 'timestamp': time.time(), 'error': None}
+            try:
+                entry['value'] = self._execute(method, args, kwargs)
+            except Exception as e:
+                entry['error'] = e
+            with self._cond:
+                if target in self._health:
+                    self._snapshot[target] = entry
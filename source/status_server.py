@@ -0,0 +1,238 @@
+"""
+Read-only HTTP view of the last line cycle.
+
+    GET /results            per-camera results and the SYSTEM/CAMx data (JSON)
+    GET /statistics         statistics published with the cycle (JSON): retries and
+                            sensor counters with LineAnalyser
+    GET /frame/<n>.jpg      image of camera n (0 based), annotated if it was decoded
+
+Every response carries the cycle as ETag, If-None-Match answers 304. The ETag also
+holds the start time of the server, so a restarted server never matches an old one.
+"""
+import asyncio
+import copy
+import json
+import threading
+import time
+import cv2
+import numpy as np
+
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        return value.decode(errors='replace')
+    return repr(value)
+
+
+class _Snapshot(object):
+    """
+    One published cycle. The bodies are encoded on the first request and kept
+    until the next cycle is published.
+
+    The images may be pooled buffers the line reuses once the cycle is old, so
+    `retire` waits for a running encoding and no new one starts afterwards.
+    """
+    RETIRED = object()
+
+    def __init__(self, cycle, results, data_struct, statistics, nonce='') -> None:
+        self.cycle = cycle
+        self.timestamp = time.time()
+        self.results = [result for result, _ in results]
+        self.images = [image for _, image in results]
+        self.data_struct = data_struct
+        self.statistics = statistics
+        self.etag = f'"{nonce}-{cycle}"'.encode()
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self._retired = False
+
+    def body(self, path, jpeg_quality):
+        """
+        :return: (content type, body), None if the path does not exist or RETIRED if
+                 the snapshot was replaced before the body was encoded
+        """
+        with self._lock:
+            if path not in self._bodies:
+                if self._retired:
+                    return self.RETIRED
+                self._bodies[path] = self._encode(path, jpeg_quality)
+            return self._bodies[path]
+
+    def retire(self):
+        with self._lock:
+            self._retired = True
+            self.images = []
+
+    def _encode(self, path, jpeg_quality):
+        if path == '/results':
+            content = {'cycle': self.cycle, 'timestamp': self.timestamp,
+                       'cameras': self.results, 'system': self.data_struct}
+        elif path == '/statistics':
+            content = {'cycle': self.cycle, 'timestamp': self.timestamp, **self.statistics}
+        elif path.startswith('/frame/') and path.endswith('.jpg'):
+            try:
+                image = self.images[int(path[7:-4])]
+            except (ValueError, IndexError):
+                return None
+            return self._encode_image(image, jpeg_quality)
+        else:
+            return None
+        return 'application/json', json.dumps(content, default=_json_default).encode()
+
+    @staticmethod
+    def _encode_image(image, jpeg_quality):
+        # Only what the cycle already transferred, never a new request to the sensor
+        if image is None:
+            return None
+        if image.decoded:
+            img = image.image
+            if img is None:
+                return None
+            ok, jpeg = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+            return ('image/jpeg', jpeg.tobytes()) if ok else None
+        if image.fetched and image.raw != b'!':
+            return 'image/jpeg', bytes(image.raw[9:])
+        return None
+
+
+class StatusServer(object):
+    """
+    Asynchronous HTTP server publishing the last cycle of a LineAnalyser.
+
+    The line calls `publish` once per cycle (LineAnalyser.publisher), which only
+    swaps a reference (and waits for an image of the previous cycle being encoded,
+    the line may reuse its buffer afterwards). The JSON and JPEG bodies are encoded on the first request
+    for them and shared by all the following readers of that cycle, so readers
+    never talk to the sensors and cost one encoding per cycle and resource.
+
+    analyser.publisher = StatusServer(port=8081).start()
+
+    Parameters
+    ----------
+    host, port:
+        address to listen on, port 0 picks a free one (see `address`).
+    jpeg_quality:
+        quality of the re-encoded annotated frames.
+    """
+    def __init__(self, host='0.0.0.0', port=8081, jpeg_quality=80) -> None:
+        self.host = host
+        self.port = port
+        self.jpeg_quality = jpeg_quality
+        self.requests = 0
+        self.not_modified = 0
+        self._snapshot = None
+        self._cycle = 0
+        # Per instance part of the ETag, the cycle count restarts with the server
+        self._nonce = '%x' % time.time_ns()
+        self._server = None
+        self._loop = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def address(self):
+        return self._server.sockets[0].getsockname()[:2]
+
+    def publish(self, results, data_struct=None, statistics=None):
+        """
+        Publish a cycle.
+
+        :param results: list of (result, LazyImage or None) tuples, see LineAnalyser.run_analizer
+        :param data_struct: SYSTEM/CAMx data, copied
+        :param statistics: JSON serialisable dict, copied
+        """
+        self._cycle += 1
+        previous = self._snapshot
+        self._snapshot = _Snapshot(self._cycle, list(results), copy.deepcopy(data_struct or {}),
+                                   copy.deepcopy(statistics or {}), self._nonce)
+        if previous is not None:
+            previous.retire()
+
+    async def serve(self):
+        """
+        Serve in the running event loop until cancelled.
+        """
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start(self):
+        """
+        Serve from a background thread with its own event loop.
+        """
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._server = self._loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port))
+            ready.set()
+            self._loop.run_forever()
+            self._server.close()
+            self._loop.run_until_complete(self._server.wait_closed())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True, name='status-server')
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                lines = request.decode('latin-1').split('\r\n')
+                method, path, _ = (lines[0].split(' ') + ['', ''])[:3]
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                self.requests += 1
+                writer.write(self._response(method, path.split('?')[0], headers))
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    return
+        finally:
+            writer.close()
+
+    def _response(self, method, path, headers):
+        if method not in ('GET', 'HEAD'):
+            return self._status(405, 'Method Not Allowed')
+        body = _Snapshot.RETIRED
+        while body is _Snapshot.RETIRED:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return self._status(503, 'Service Unavailable')
+            body = snapshot.body(path, self.jpeg_quality)
+        if body is None:
+            return self._status(404, 'Not Found')
+        if headers.get('if-none-match') == snapshot.etag.decode():
+            self.not_modified += 1
+            return b'HTTP/1.1 304 Not Modified\r\nETag: ' + snapshot.etag + b'\r\n\r\n'
+        content_type, content = body
+        head = (b'HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                b'Cache-Control: no-cache\r\nETag: %s\r\n\r\n'
+                % (content_type.encode(), len(content), snapshot.etag))
+        return head if method == 'HEAD' else head + content
+
+    @staticmethod
+    def _status(code, reason):
+        return b'HTTP/1.1 %d %s\r\nContent-Length: 0\r\n\r\n' % (code, reason.encode())
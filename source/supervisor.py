@@ -0,0 +1,227 @@
+import multiprocessing
+import multiprocessing.connection
+import os
+import time
+from .o2d22x import O2D22xPCICDevice
+from .retry import RetryPolicy, RetryExhausted
+
+
+def _connect(ip, port):
+    try:
+        return O2D22xPCICDevice(ip, port)
+    except OSError as e:
+        print(f"<{ip}> Connection error: {e}")
+        return None
+
+
+def _worker(worker_id, ips, port, core, images, tries, conn):
+    """
+    Worker process: owns the connections of its cameras and evaluates them on every cycle.
+    """
+    if core is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {core})
+    policy = RetryPolicy(tries=tries)
+    devices = {ip: _connect(ip, port) for ip in ips}
+    while True:
+        try:
+            command = conn.recv()
+        except EOFError:
+            return
+        if command is None:
+            return
+        cycle, app = command
+        snapshot = {}
+        for ip in ips:
+            entry = {'result': None, 'image': None, 'error': None, 'timestamp': time.time()}
+            if devices[ip] is None:
+                devices[ip] = _connect(ip, port)
+            device = devices[ip]
+            try:
+                if device is None:
+                    raise ConnectionError('not connected')
+                if app is not None:
+                    device.ensure_application(app)
+                try:
+                    entry['result'] = policy.run(ip, device.evaluate_image_decoded)
+                except RetryExhausted:
+                    entry['result'] = {'result': 'FAIL'}
+                if images:
+                    # Raw JPEG, decoding is left to the consumer to keep the IPC small
+                    entry['image'] = bytes(device.request_image(entry['result']['result']))
+            except (OSError, RuntimeError) as e:
+                entry['error'] = repr(e)
+                if device is not None:
+                    device.close()
+                devices[ip] = None
+            snapshot[ip] = entry
+        conn.send((cycle, snapshot, policy.stats))
+
+
+class CameraSupervisor(object):
+    """
+    Spreads the cameras of a line over worker processes, one Python interpreter
+    (and GIL) per worker, each optionally pinned to a core.
+
+    Every worker opens its own PCIC connections and talks to the supervisor through
+    its own pipe, so a crashed worker can not block the others. `run_cycle` triggers
+    all the workers at once and merges their answers into one line snapshot. A worker
+    that died is restarted before the next cycle, the other workers keep their connections.
+    PCIC sockets have no timeout, so a worker stuck on an unresponsive camera never
+    exits: it is killed and restarted after `max_timeouts` consecutive cycles without
+    an answer.
+
+    Parameters
+    ----------
+    ip_list:
+        camera addresses.
+    port:
+        PCIC port.
+    workers:
+        number of worker processes, one per core (at most one per camera) by default.
+    pin:
+        pin worker i to core i % cpu_count (Linux only).
+    images:
+        transfer the raw JPEG of every evaluation.
+    tries:
+        evaluation attempts per camera and cycle.
+    start_method:
+        multiprocessing start method.
+    max_timeouts:
+        consecutive cycle timeouts after which a worker is killed and restarted.
+    """
+    def __init__(self, ip_list, port=50010, workers=None, pin=True, images=False, tries=3,
+                 start_method='spawn', max_timeouts=3) -> None:
+        self.ip_list = list(ip_list)
+        self.port = port
+        self.images = images
+        self.tries = tries
+        cores = os.cpu_count() or 1
+        if workers is None:
+            workers = cores
+        workers = max(1, min(workers, len(self.ip_list)))
+        self.shards = [self.ip_list[i::workers] for i in range(workers)]
+        self.cores = [i % cores if pin else None for i in range(workers)]
+        self.cycle = 0
+        self.restarts = [0] * workers
+        self.max_timeouts = max_timeouts
+        self.timeouts = [0] * workers
+        self.retry_stats = {}
+        self._ctx = multiprocessing.get_context(start_method)
+        self._processes = [None] * workers
+        self._conns = [None] * workers
+        for i in range(workers):
+            self._start(i)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.shards)
+
+    def _start(self, i):
+        self.timeouts[i] = 0
+        if self._conns[i] is not None:
+            self._conns[i].close()
+        self._conns[i], child_conn = self._ctx.Pipe()
+        self._processes[i] = self._ctx.Process(
+            target=_worker, daemon=True, name=f'camera-worker-{i}',
+            args=(i, self.shards[i], self.port, self.cores[i], self.images, self.tries, child_conn))
+        self._processes[i].start()
+        child_conn.close()
+
+    def restart_dead(self):
+        """
+        Restart the workers that are not alive.
+
+        :return: indexes of the restarted workers
+        """
+        restarted = []
+        for i, process in enumerate(self._processes):
+            if not process.is_alive():
+                print(f"<worker {i}> exited with {process.exitcode}, restarting")
+                self.restarts[i] += 1
+                self._start(i)
+                restarted.append(i)
+        return restarted
+
+    def run_cycle(self, app=None, timeout=5.0):
+        """
+        Evaluate every camera once.
+
+        :param app: application to select before evaluating, None keeps the active one
+        :param timeout: seconds to wait for the workers
+        :return: {'cycle', 'timestamp', 'complete', 'cameras': {ip: {'result', 'image',
+                 'error', 'timestamp'}}}, cameras of a worker that did not answer have
+                 their error set
+        """
+        self.restart_dead()
+        self.cycle += 1
+        cycle = self.cycle
+        failed = {}
+        for i, conn in enumerate(self._conns):
+            try:
+                conn.send((cycle, app))
+            except OSError:
+                failed[i] = 'worker crashed'
+
+        pending = {conn: i for i, conn in enumerate(self._conns) if i not in failed}
+        cameras = {}
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for conn in multiprocessing.connection.wait(list(pending), remaining):
+                try:
+                    answer_cycle, snapshot, stats = conn.recv()
+                except (EOFError, OSError):
+                    failed[pending.pop(conn)] = 'worker crashed'
+                    continue
+                # Answers of a cycle that timed out before are discarded
+                if answer_cycle == cycle:
+                    self.timeouts[pending.pop(conn)] = 0
+                    cameras.update(snapshot)
+                    self.retry_stats.update(stats)
+        for i in pending.values():
+            failed[i] = 'worker timeout'
+            self.timeouts[i] += 1
+            if self.timeouts[i] >= self.max_timeouts:
+                self._kill(i)
+
+        for i, error in failed.items():
+            for ip in self.shards[i]:
+                cameras[ip] = {'result': None, 'image': None, 'error': error, 'timestamp': time.time()}
+
+        return {
+            'cycle': cycle,
+            'timestamp': time.time(),
+            'complete': all(cameras[ip]['error'] is None for ip in self.ip_list),
+            'cameras': {ip: cameras[ip] for ip in self.ip_list},
+        }
+
+    def _kill(self, i, timeout=1.0):
+        """
+        Stop a worker that stopped answering, it is restarted before the next cycle.
+        """
+        process = self._processes[i]
+        print(f"<worker {i}> no answer for {self.timeouts[i]} cycles, killing it")
+        process.terminate()
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join(timeout)
+
+    def close(self, timeout=2.0):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+        for process, conn in zip(self._processes, self._conns):
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
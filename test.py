@@ -1,6 +1,40 @@
+import asyncio
+import errno
+import io
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib.error
+import urllib.request
+import cv2
 import numpy as np
 from line_analizer import LineAnalyser
+from source.retry import RetryPolicy, RetryExhausted
+from source.emulator import O2D22xEmulator
+from source.discovery import discover
+from source.result_parser import parse_result
+from source.job_queue import ApplicationJobQueue
+from source.o2d22x import O2D22xPCICDevice, SENT, RECEIVED
+from source.recorder import TrafficRecorder, TRUNCATED, load, replay
+from source.supervisor import CameraSupervisor
+from source.scheduler import CommandScheduler, EVALUATION, HEALTH
+from source.calibration import LineCalibration
+from source.archive import ArchiveWriter, ArchiveReader, list_segments
+from source.pipeline import PipelinedAcquisition
+from source.buffer_pool import BufferPool
+from source.lazy_image import ImagePolicy
+from source.emulator import synthetic_image
+from source.correlation import FrameCorrelator, CHUNK_HEADER
+from source.status_server import StatusServer
+from source.emulator import XmlRpcEmulator
+from source.rpc.async_rpc_client import AsyncXmlRpcCameraProxy, AsyncXmlRpcProxyManager
+from source.rpc.metadata_cache import MetadataCache
+from source.rpc.rpc_client import XmlRpcCameraProxy
+from source.bench import bench_pcic, bench_rpc, bench_alloc
 
 
 class TestLineAnalyser(unittest.TestCase):
@@ -13,7 +47,727 @@ class TestLineAnalyser(unittest.TestCase):
         for i in result:
             self.assertIsInstance(i, tuple)
             self.assertIsInstance(i[0], dict)
-            self.assertIsInstance(i[1], np.ndarray)
+            self.assertIsInstance(i[1].image, np.ndarray)
+
+
+class _LineEmulator(O2D22xEmulator):
+    """
+    Sensor of a line: the triggers numbered in `fail` take `slow` seconds and answer
+    '!', with `chunks` the images are V3 binary chunks whose frame count jumps after
+    the triggers numbered in `skip`.
+    """
+    fail = ()
+    slow = 0.0
+    chunks = False
+    skip = ()
+    triggers = 0
+
+    def answer(self, cmd):
+        if cmd == b'T?':
+            self.triggers += 1
+            if self.triggers in self.fail:
+                time.sleep(self.slow)
+                return b'!'
+        if cmd in (b'I?', b'F?') and self.chunks:
+            frame = self.triggers + sum(1 for n in self.skip if n <= self.triggers)
+            now = time.time()
+            header = CHUNK_HEADER.pack(0, 64 + len(self.image), 64, 3, 640, 480, 0, 0, frame, 0,
+                                       int(now), int(now % 1 * 1e9)).ljust(64, b'\0')
+            return b'%09d' % (64 + len(self.image)) + header + self.image
+        return super().answer(cmd)
+
+
+class TestAnalyserCorrelation(unittest.TestCase):
+    takt = 0.4
+
+    def run_line(self, cycles=4, prefetch=False, **camera):
+        """
+        Run the analyser at the line takt over 3 emulators, the second one gets `camera`.
+        """
+        ip_list = ['127.0.0.4', '127.0.0.5', '127.0.0.6']
+        emulators = [_LineEmulator(ip, 50010, delay=0.01, name=ip) for ip in ip_list]
+        emulators[1].__dict__.update(camera)
+        for emulator in emulators:
+            emulator.start()
+        try:
+            analyser = LineAnalyser(ip_list, image_policy=ImagePolicy('always', prefetch=prefetch))
+            correlator = analyser.correlate(self.takt)
+            start = time.monotonic()
+            for cycle in range(cycles):
+                time.sleep(max(0.0, start + cycle * self.takt - time.monotonic()))
+                analyser.run_analizer(annotate=False)
+            snapshots = sorted(correlator.poll() + correlator.flush(), key=lambda snapshot: snapshot.part)
+            for camera in analyser.cameras:
+                camera.close()
+        finally:
+            for emulator in emulators:
+                emulator.stop()
+        return snapshots
+
+    def test_ordered_cycles(self):
+        snapshots = self.run_line()
+        self.assertEqual(len(snapshots), 4)
+        for snapshot in snapshots:
+            self.assertTrue(snapshot.complete)
+            self.assertEqual(snapshot.misaligned, ())
+
+    def test_late_retry_leaves_the_part_incomplete(self):
+        # The retry of the second camera is triggered half a takt after the first one
+        snapshots = self.run_line(fail=(2,), slow=self.takt / 2)
+        self.assertEqual([snapshot.complete for snapshot in snapshots], [True, False, False, True, True])
+        self.assertEqual(snapshots[1].missing, ('127.0.0.5', '127.0.0.6'))
+        self.assertEqual(snapshots[2].missing, ('127.0.0.4',))
+
+    def test_camera_giving_up_is_missing(self):
+        snapshots = self.run_line(fail=(2, 3, 4))
+        self.assertEqual([snapshot.complete for snapshot in snapshots], [True, False, True, True])
+        self.assertEqual(snapshots[1].missing, ('127.0.0.5',))
+
+    def test_frame_count_jump_is_misaligned(self):
+        snapshots = self.run_line(prefetch=True, chunks=True, skip=(2,))
+        self.assertEqual(len(snapshots), 4)
+        self.assertTrue(all(snapshot.complete for snapshot in snapshots))
+        self.assertEqual([snapshot.misaligned for snapshot in snapshots], [(), ('127.0.0.5',), (), ()])
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_retries_until_success(self):
+        answers = ['!', {'result': '0FAIL'}, {'result': '0PASS'}]
+        policy = RetryPolicy(tries=3)
+        result = policy.run('cam', lambda: answers.pop(0))
+        self.assertEqual(result, {'result': '0PASS'})
+        stats = policy.get_stats('cam')
+        self.assertEqual(stats['attempts'], 3)
+        self.assertEqual(stats['busy'], 1)
+        self.assertEqual(stats['fail'], 1)
+
+    def test_deadline_stops_retries(self):
+        policy = RetryPolicy(tries=10, budget=0)
+        with self.assertRaises(RetryExhausted) as ctx:
+            policy.run('cam', lambda: '!')
+        self.assertEqual(ctx.exception.kind, 'busy')
+        self.assertEqual(policy.get_stats('cam')['attempts'], 1)
+        self.assertEqual(policy.get_stats('cam')['deadline_misses'], 1)
+
+
+class TestDiscovery(unittest.TestCase):
+    def test_discover_loopback(self):
+        emulators = [O2D22xEmulator(f'127.0.0.{i}', 50010, name=f'cam{i}').start() for i in (2, 3)]
+        try:
+            found = discover('127.0.0.0/24', refresh=True)
+        finally:
+            for emulator in emulators:
+                emulator.stop()
+        self.assertEqual([info['pcic_address'] for info in found], ['127.0.0.2', '127.0.0.3'])
+        self.assertEqual(found[0]['name'], 'cam2')
+        self.assertEqual(discover('127.0.0.0/24'), found)
+
+
+class TestResultParser(unittest.TestCase):
+    def test_parse_multiple_instances(self):
+        parsed = parse_result('startPASS#0.9#2#1#10#20#0.5#0.9#2#30#40#1.5#0.8#model#imagestop')
+        self.assertEqual(parsed.result, 'PASS')
+        self.assertEqual(parsed.count, 2)
+        np.testing.assert_array_equal(parsed.instances['index'], [1, 2])
+        np.testing.assert_array_equal(parsed.instances['x'], [10, 30])
+        np.testing.assert_array_equal(parsed.instances['rot'], [0.5, 1.5])
+        self.assertEqual(parsed.model_info, 'model')
+        self.assertEqual(parsed.image_info, 'image')
+
+    def test_parse_without_instances(self):
+        parsed = parse_result('startFAIL#0.1#0stop')
+        self.assertEqual(parsed.result, 'FAIL')
+        self.assertEqual(len(parsed.instances), 0)
+        self.assertIsNone(parsed.model_info)
+        self.assertEqual(parse_result('!'), '!')
+        with self.assertRaises(ValueError):
+            parse_result('startPASS#0.9#2#1#10#20stop')
+
+
+class TestRequestImage(unittest.TestCase):
+    def test_pass_requests_last_image(self):
+        with O2D22xEmulator() as emulator:
+            device = O2D22xPCICDevice(*emulator.address)
+            commands = []
+            send_command = device.send_command
+            device.send_command = lambda cmd, into=None: commands.append(cmd) or send_command(cmd, into)
+            for result in ('PASS', '0PASS', 'FAIL', '0FAIL'):
+                device.request_image(result)
+            device.close()
+        self.assertEqual(commands, ['I?', 'I?', 'F?', 'F?'])
+
+
+class _MovingEmulator(O2D22xEmulator):
+    """
+    Every trigger moves the object, the image always shows the last evaluated position.
+    """
+    def answer(self, cmd):
+        if cmd == b'T?':
+            x = 100 + 40 * (self.statistics[0] % 10)
+            self.result = f'startPASS#0.95#1#1#{x}#240#0.5#0.9stop'
+            self.image = synthetic_image(x=x)
+        return super().answer(cmd)
+
+
+class TestPipelinedAcquisition(unittest.TestCase):
+    def test_result_image_pairing(self):
+        with _MovingEmulator() as emulator:
+            device = O2D22xPCICDevice(*emulator.address)
+            pipeline = PipelinedAcquisition(device, depth=2)
+            pipeline.start()
+            frames = []
+            for frame in pipeline:
+                frames.append(frame)
+                if len(frames) == 12:
+                    threading.Thread(target=pipeline.stop).start()
+            device.close()
+        self.assertGreaterEqual(len(frames), 12)
+        self.assertEqual([frame.seq for frame in frames], list(range(len(frames))))
+        for frame in frames:
+            column = int(np.argmax(frame.image.sum(axis=(0, 2))))
+            self.assertLessEqual(abs(column - frame.result['x']), 3)
+
+    def test_pooled_frames_are_reused(self):
+        pool = BufferPool.frames(2)
+        with _MovingEmulator() as emulator:
+            device = O2D22xPCICDevice(*emulator.address)
+            pipeline = PipelinedAcquisition(device, depth=2, pool=pool)
+            pipeline.start()
+            frames = []
+            for frame in pipeline:
+                column = int(np.argmax(frame.image.sum(axis=(0, 2))))
+                self.assertLessEqual(abs(column - frame.result['x']), 3)
+                pipeline.release(frame)
+                frames.append(frame)
+                if len(frames) == 8:
+                    threading.Thread(target=pipeline.stop).start()
+            device.close()
+        self.assertEqual(pool.created, 1)
+        self.assertEqual(pool.in_use, 0)
+
+
+class TestImagePolicy(unittest.TestCase):
+    results = ['startPASS#0.95#1#1#320#240#0.5#0.9stop', 'startFAIL#0.10#0stop'] * 3
+
+    def run_cycles(self, policy):
+        """
+        Evaluate PASS, FAIL, PASS ... and access the image of every handle.
+
+        :return: (image commands sent, images)
+        """
+        with O2D22xEmulator() as emulator:
+            device = O2D22xPCICDevice(*emulator.address)
+            commands = []
+            send_command = device.send_command
+            device.send_command = lambda cmd, into=None: commands.append(cmd) or send_command(cmd, into)
+            images = []
+            for result in self.results:
+                emulator.result = result
+                evaluation = device.evaluate_image_decoded()
+                images.append(policy.handle(device, evaluation['result']).image)
+            device.close()
+        return [command for command in commands if command in ('I?', 'F?')], images
+
+    def test_always(self):
+        commands, images = self.run_cycles(ImagePolicy('always'))
+        self.assertEqual(commands, ['I?', 'F?'] * 3)
+        self.assertTrue(all(isinstance(image, np.ndarray) for image in images))
+
+    def test_fail_only(self):
+        commands, images = self.run_cycles(ImagePolicy('fail_only'))
+        self.assertEqual(commands, ['F?'] * 3)
+        self.assertEqual([image is None for image in images], [True, False] * 3)
+
+    def test_sampled(self):
+        commands, images = self.run_cycles(ImagePolicy('sampled', every=3))
+        self.assertEqual(commands, ['I?', 'F?'])
+        self.assertEqual([image is None for image in images], [False, True, True, False, True, True])
+
+    def test_never(self):
+        commands, images = self.run_cycles(ImagePolicy('never'))
+        self.assertEqual(commands, [])
+        self.assertEqual(images, [None] * 6)
+
+    def test_stale_and_released_handles(self):
+        policy = ImagePolicy('always')
+        with O2D22xEmulator() as emulator:
+            device = O2D22xPCICDevice(*emulator.address)
+            device.evaluate_image_decoded()
+            stale = policy.handle(device, 'PASS')
+            pinned = policy.handle(device, 'PASS').fetch()
+            device.evaluate_image_decoded()
+            with self.assertRaises(RuntimeError):
+                stale.image
+            self.assertIsInstance(pinned.image, np.ndarray)
+            pinned.release()
+            with self.assertRaises(RuntimeError):
+                pinned.raw
+            device.close()
+
+
+class TestLazyImage(unittest.TestCase):
+    def test_release_returns_pooled_buffers(self):
+        frames, receive = BufferPool.frames(1), BufferPool.receive(1)
+        policy = ImagePolicy('always', frames=frames, receive=receive)
+        with O2D22xEmulator() as emulator:
+            device = O2D22xPCICDevice(*emulator.address)
+            decoded = []
+            for _ in range(3):
+                device.evaluate_image_decoded()
+                handle = policy.handle(device, 'PASS')
+                self.assertEqual(handle.image.shape, (480, 640, 3))
+                decoded.append(id(handle.image))
+                self.assertEqual((frames.in_use, receive.in_use), (1, 1))
+                handle.release()
+                with self.assertRaises(RuntimeError):
+                    handle.raw
+            device.close()
+        self.assertEqual(len(set(decoded)), 1)
+        self.assertEqual((frames.created, receive.created), (1, 1))
+        self.assertEqual((frames.in_use, receive.in_use), (0, 0))
+
+
+class TestArchive(unittest.TestCase):
+    def test_rotation_and_read_back(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'images')
+            images = [bytes([i]) * 400 for i in range(5)]
+            with ArchiveWriter(path, max_bytes=1000) as writer:
+                for i, jpeg in enumerate(images):
+                    writer.append(f'cam{i}', 'PASS', jpeg, timestamp=float(i))
+            self.assertEqual(list_segments(path), [0, 1, 2])
+            with ArchiveReader(path, 1) as reader:
+                self.assertEqual(len(reader), 2)
+                self.assertEqual(bytes(reader[-1].jpeg), images[3])
+            records = [(r.camera, r.timestamp, r.result, bytes(r.jpeg)) for r in ArchiveReader.replay(path)]
+        self.assertEqual(records, [(f'cam{i}', float(i), 'PASS', jpeg) for i, jpeg in enumerate(images)])
+
+    def test_close_after_writer_died(self):
+        class DiskFull(io.BytesIO):
+            def write(self, data):
+                raise OSError(errno.ENOSPC, 'No space left on device')
+
+        writer = ArchiveWriter('images', queue_size=1, opener=lambda path, mode: DiskFull())
+        self.assertTrue(writer.append('cam', 'PASS', b'jpeg'))
+        deadline = time.monotonic() + 5
+        while writer.error is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIsInstance(writer.error, OSError)
+        self.assertEqual(writer.error.errno, errno.ENOSPC)
+        # Nobody empties the queue any more: one image waits, the next is dropped
+        self.assertTrue(writer.append('cam', 'PASS', b'jpeg'))
+        self.assertFalse(writer.append('cam', 'PASS', b'jpeg'))
+        start = time.monotonic()
+        writer.close()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertEqual((writer.written, writer.dropped), (0, 1))
+
+    def test_unwritable_path(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with ArchiveWriter(os.path.join(folder, 'missing', 'images')) as writer:
+                writer.append('cam', 'PASS', b'jpeg')
+        self.assertIsInstance(writer.error, FileNotFoundError)
+        self.assertEqual(writer.written, 0)
+
+
+class TestLineCalibration(unittest.TestCase):
+    def test_classify_uniform(self):
+        calibration = LineCalibration.uniform(4, 3.0)
+        results = [
+            {'result': 'FAIL', 'x': None, 'y': None, 'rot': None},
+            {'result': 'PASS', 'x': 120, 'y': 40, 'rot': 20.0},     # on the margins and the limit
+            {'result': 'PASS', 'x': 119, 'y': 240, 'rot': 0.0},     # 1 px outside in x
+            {'result': 'PASS', 'x': 350, 'y': 240, 'rot': -20.5},   # orientation over the limit
+        ]
+        classified = calibration.classify(results, 200, 200, 20, 100.0)
+        self.assertEqual(classified['fail'].tolist(), [True, False, False, False])
+        self.assertEqual(classified['misoriented'].tolist(), [False, False, False, True])
+        self.assertEqual(classified['outside'].tolist(), [False, False, True, True])
+        self.assertEqual(classified['gap'].tolist(), [False, False, False, False])
+        np.testing.assert_allclose(classified['offset'][3], [-10.0, 0.0])
+        np.testing.assert_allclose(classified['offset_px'][1], [200, 200])
+
+        data = calibration.fill({'SYSTEM': {}}, classified)
+        self.assertEqual(data['SYSTEM'], {'FAIL': 1, 'GAP': 0, 'OUTSIDE': 1})
+        self.assertEqual(data['CAM1']['FAIL'], 1)
+        self.assertEqual(data['CAM1']['POSX'], 0.0)
+        self.assertAlmostEqual(data['CAM4']['POSX'], 350 / 3.0)
+        self.assertEqual(data['CAM4']['ORIE'], -20.5)
+
+        classified = calibration.classify(results[1:2] * 4, 200, 200, 20, 10.0)
+        self.assertEqual(calibration.fill({'SYSTEM': {}}, classified)['SYSTEM'],
+                         {'FAIL': 0, 'GAP': 0, 'OUTSIDE': 0})
+
+    def test_gap_from_the_line_offset(self):
+        calibration = LineCalibration.uniform(5, 3.0)
+        results = [
+            {'result': 'PASS', 'x': 320, 'y': 240, 'rot': 0.0},
+            {'result': 'PASS', 'x': 320, 'y': 240, 'rot': 0.0},
+            {'result': 'PASS', 'x': 320, 'y': 270, 'rot': 0.0},     # 10 mm off the line, on the tolerance
+            {'result': 'PASS', 'x': 353, 'y': 240, 'rot': 0.0},     # 11 mm off the line
+            {'result': 'FAIL', 'x': None, 'y': None, 'rot': None},
+        ]
+        classified = calibration.classify(results, 200, 200, 20, 10.0)
+        self.assertEqual(classified['gap'].tolist(), [False, False, False, True, False])
+        self.assertFalse(classified['outside'].any())
+        self.assertEqual(calibration.fill({'SYSTEM': {}}, classified)['SYSTEM'],
+                         {'FAIL': 1, 'GAP': 1, 'OUTSIDE': 0})
+
+        # The line is the median offset, not the image centre: a common shift is no gap
+        shifted = [dict(r, x=r['x'] + 60) if r['x'] is not None else r for r in results]
+        classified = calibration.classify(shifted, 200, 200, 20, 10.0)
+        self.assertEqual(classified['gap'].tolist(), [False, False, False, True, False])
+
+
+class _LoggingDevice(object):
+    def __init__(self) -> None:
+        self.log = []
+
+    def evaluate(self, n):
+        time.sleep(0.05)
+        self.log.append(f'T{n}')
+
+    def image(self, n):
+        self.log.append(f'I{n}')
+
+    def statistics(self):
+        self.log.append('s')
+        return len(self.log)
+
+
+class TestCommandScheduler(unittest.TestCase):
+    def test_image_is_not_overtaken(self):
+        device = _LoggingDevice()
+        with CommandScheduler(device, {}) as scheduler:
+            futures = [scheduler.submit('evaluate', 1),
+                       scheduler.submit('image', 1),
+                       scheduler.submit('evaluate', 2),
+                       scheduler.submit('image', 2)]
+            for future in futures:
+                future.result(5)
+        self.assertEqual(device.log, ['T1', 'I1', 'T2', 'I2'])
+
+    def test_health_command_yields_to_evaluations(self):
+        device = _LoggingDevice()
+        with CommandScheduler(device, {}) as scheduler:
+            futures = [scheduler.submit('evaluate', 1),
+                       scheduler.submit('statistics', priority=HEALTH),
+                       scheduler.submit('image', 1, priority=EVALUATION),
+                       scheduler.submit('evaluate', 2)]
+            for future in futures:
+                future.result(5)
+        self.assertEqual(device.log, ['T1', 'I1', 'T2', 's'])
+
+    def test_health_only_when_idle(self):
+        device = _LoggingDevice()
+        with CommandScheduler(device, {'stats': ('statistics', 0.0)}) as scheduler:
+            futures = [scheduler.submit('evaluate', n) for n in range(4)]
+            for future in futures:
+                future.result(5)
+            time.sleep(0.05)
+            snapshot = scheduler.health('stats')
+        commands = [entry for entry in device.log if entry != 's']
+        first = device.log.index('T0')
+        self.assertEqual(device.log[first:first + 4], commands[:4])
+        self.assertIsNotNone(snapshot)
+        self.assertIsNone(snapshot['error'])
+
+
+class TestCameraSupervisor(unittest.TestCase):
+    def test_restart_crashed_and_stuck_workers(self):
+        fast = O2D22xEmulator('127.0.0.1', 0)
+        port = fast.address[1]
+        slow = O2D22xEmulator('127.0.0.2', port)
+        fast.start()
+        slow.start()
+        try:
+            with CameraSupervisor(['127.0.0.1', '127.0.0.2'], port, workers=2, pin=False,
+                                  max_timeouts=2) as supervisor:
+                self.assertTrue(supervisor.run_cycle(timeout=10)['complete'])
+
+                supervisor._processes[0].kill()
+                supervisor._processes[0].join()
+                self.assertTrue(supervisor.run_cycle(timeout=10)['complete'])
+                self.assertEqual(supervisor.restarts, [1, 0])
+
+                slow.delay = 30.0
+                for _ in range(2):
+                    snapshot = supervisor.run_cycle(timeout=0.5)
+                    self.assertEqual(snapshot['cameras']['127.0.0.2']['error'], 'worker timeout')
+                    self.assertIsNone(snapshot['cameras']['127.0.0.1']['error'])
+                slow.delay = 0.0
+                snapshot = supervisor.run_cycle(timeout=10)
+                self.assertEqual(supervisor.restarts, [1, 1])
+                self.assertTrue(snapshot['complete'])
+        finally:
+            fast.stop()
+            slow.stop()
+
+
+class TestTrafficRecorder(unittest.TestCase):
+    def test_record_header_and_body(self):
+        with tempfile.TemporaryDirectory() as folder:
+            recorder = TrafficRecorder(64, os.path.join(folder, 'capture.bin'), 'cam')
+            recorder.record(SENT, b'1000L000000008\r\n1000T?\r\n')
+            recorder.record(RECEIVED, b'head', memoryview(b'body'))
+            # Larger than a buffer, truncated
+            recorder.record(RECEIVED, b'h' * 10, b'b' * 100)
+            name, frames = load(recorder.dump())
+        self.assertEqual(name, 'cam')
+        self.assertEqual([(direction, data) for _, direction, data in frames[-2:]],
+                         [(RECEIVED, b'headbody'), (RECEIVED | TRUNCATED, b'h' * 10 + b'b' * 41)])
+
+    def test_replay_skips_truncated_answers(self):
+        def frame(ticket, data):
+            return b'%sL%09d\r\n%s%s\r\n' % (ticket, len(data) + 6, ticket, data)
+
+        result = b'startPASS#0.95#1#1#320#240#0.5#0.9stop'
+        image = frame(b'1000', b'%09d' % 5000 + b'x' * 5000)
+        frames = [(0, SENT, frame(b'1000', b'I?')), (1, RECEIVED | TRUNCATED, image[:100]),
+                  (2, SENT, frame(b'1000', b'R?')), (3, RECEIVED, frame(b'1000', result))]
+        self.assertEqual([(command, bytes(answer)) for command, _, answer in replay(frames)],
+                         [(b'R?', result)])
+
+
+class TestApplicationJobQueue(unittest.TestCase):
+    def test_groups_jobs_by_application(self):
+        with O2D22xEmulator() as emulator:
+            device = O2D22xPCICDevice(*emulator.address)
+            order = []
+            with ApplicationJobQueue(device, max_delay=10.0) as queue:
+                queue.submit(1, lambda device: time.sleep(0.2))
+                futures = [queue.submit(app, lambda device, i=i: order.append(i))
+                           for i, app in enumerate([2, 1, 2, 1])]
+                for future in futures:
+                    future.result(5)
+                stats = queue.stats
+            device.close()
+        self.assertEqual(order, [1, 3, 0, 2])
+        self.assertEqual(stats['switches'], 2)
+        self.assertEqual(stats['fifo_switches'], 4)
+        self.assertEqual(emulator.switches, 2)
+
+
+class TestFrameCorrelator(unittest.TestCase):
+    def test_snapshots(self):
+        correlator = FrameCorrelator(['a', 'b'], tolerance=0.05, timeout=1.0)
+        correlator.add('a', 1, timestamp=10.00, frame_count=1)
+        correlator.add('b', 2, timestamp=10.02, frame_count=7)
+        # b missed the next trigger, a re-read the same frame
+        correlator.add('a', 3, timestamp=11.00, frame_count=2)
+        self.assertIsNone(correlator.add('a', 3, timestamp=11.01, frame_count=2))
+        correlator.add('a', 5, timestamp=12.00, frame_count=3)
+        correlator.add('b', 6, timestamp=12.01, frame_count=9)
+        snapshots = correlator.poll(12.01)
+        self.assertEqual([s.part for s in snapshots], [1, 2, 3])
+        self.assertEqual(snapshots[0].results, {'a': 1, 'b': 2})
+        self.assertTrue(snapshots[0].complete)
+        self.assertEqual(snapshots[1].missing, ('b',))
+        self.assertEqual(snapshots[2].misaligned, ('b',))
+        self.assertEqual(correlator.duplicates, 1)
+
+
+class TestStatusServer(unittest.TestCase):
+    def test_etag(self):
+        with StatusServer('127.0.0.1', 0) as server:
+            url = 'http://%s:%d/results' % server.address
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(url)
+            self.assertEqual(error.exception.code, 503)
+            server.publish([({'result': 'PASS', 'all_instances': np.zeros(1)}, None)])
+            response = urllib.request.urlopen(url)
+            self.assertIn(b'"PASS"', response.read())
+            request = urllib.request.Request(url, headers={'If-None-Match': response.headers['ETag']})
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(request)
+            self.assertEqual(error.exception.code, 304)
+            etag = response.headers['ETag']
+        # Same cycle count after a restart, but a different ETag
+        with StatusServer('127.0.0.1', 0) as server:
+            server.publish([({'result': 'FAIL'}, None)])
+            request = urllib.request.Request('http://%s:%d/results' % server.address,
+                                             headers={'If-None-Match': etag})
+            self.assertIn(b'"FAIL"', urllib.request.urlopen(request).read())
+
+    def test_line_statistics_and_frames(self):
+        with O2D22xEmulator('127.0.0.11', 50010) as emulator, StatusServer('127.0.0.1', 0) as server:
+            analyser = LineAnalyser(['127.0.0.11'])
+            analyser.use_buffer_pools(depth=1)
+            analyser.publisher = server
+            for _ in range(3):
+                analyser.run_analizer()
+            url = 'http://%s:%d' % server.address
+            statistics = json.loads(urllib.request.urlopen(url + '/statistics').read())
+            jpeg = urllib.request.urlopen(url + '/frame/0.jpg').read()
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(url + '/frame/1.jpg')
+            analyser.cameras[0].close()
+        self.assertEqual(error.exception.code, 404)
+        self.assertEqual(statistics['cycle'], 3)
+        self.assertIn('127.0.0.11', statistics['retries'])
+        # Read on the first cycle only, the interval is 5 s
+        self.assertEqual(statistics['sensors']['127.0.0.11']['total'], 1)
+        self.assertEqual(emulator.statistics[0], 3)
+        image = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(image.shape, (480, 640, 3))
+
+
+class TestAsyncXmlRpc(unittest.TestCase):
+    def test_detection(self):
+        async def run(port):
+            proxy = AsyncXmlRpcCameraProxy('127.0.0.1', port)
+            await proxy.connect("3.5.0061")
+            await proxy.init_config()
+            result = await proxy.execute_detection()
+            with self.assertRaises(asyncio.TimeoutError):
+                await proxy.call('xmlExecuteTrigger', timeout=0.01)
+            return result
+
+        with XmlRpcEmulator(delay=0.1) as emulator:
+            result = asyncio.run(run(emulator.address[1]))
+        self.assertEqual(result['error'], 0)
+        self.assertEqual(result['id_app'], 'Ak0xAw__')
+
+    def test_cancel(self):
+        async def run(port):
+            proxy = AsyncXmlRpcCameraProxy('127.0.0.1', port)
+            await proxy.connect("3.5.0061")
+            task = asyncio.ensure_future(proxy.execute_detection())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            # The interrupted exchange is dropped, the next call uses a new connection
+            self.assertIsNone(proxy.transport._writer)
+            return await proxy.call('xmlPollResults')
+
+        with XmlRpcEmulator(delay=0.5) as emulator:
+            self.assertEqual(asyncio.run(run(emulator.address[1])), [0, 1])
+
+    @staticmethod
+    def detect(emulators, port, budget=None):
+        async def run():
+            manager = AsyncXmlRpcProxyManager([emulator.address[0] for emulator in emulators], port,
+                                              budget=budget, timeout=2.0)
+            await manager.connect()
+            await manager.init_config()
+            start = time.monotonic()
+            results = await manager.execute_detection()
+            return results, time.monotonic() - start, manager.retry_policy
+
+        try:
+            return asyncio.run(run())
+        finally:
+            for emulator in emulators:
+                emulator.stop()
+
+    def test_manager_runs_cameras_at_once(self):
+        first = XmlRpcEmulator('127.0.0.7', 0, delay=0.3).start()
+        port = first.address[1]
+        emulators = [first] + [XmlRpcEmulator(f'127.0.0.{i}', port, delay=0.3).start() for i in (8, 9)]
+        results, elapsed, _ = self.detect(emulators, port)
+        self.assertEqual([result['error'] for result in results], [0, 0, 0])
+        self.assertLess(elapsed, 0.6)
+
+    def test_silent_sensor_is_bounded_by_the_deadline(self):
+        class Silent(XmlRpcEmulator):
+            def xmlPollResults(self):
+                return [0, 0]
+
+        first = XmlRpcEmulator('127.0.0.7', 0).start()
+        port = first.address[1]
+        silent = Silent('127.0.0.8', port).start()
+        results, elapsed, policy = self.detect([first, silent], port, budget=0.5)
+        self.assertEqual([result['error'] for result in results], [0, 1])
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(policy.stats[f'http://127.0.0.8:{port}/RPC2']['deadline_misses'], 1)
+
+
+class TestBench(unittest.TestCase):
+    report_keys = {'cycles', 'throughput_per_s', 'latency_ms', 'bytes_per_cycle', 'cpu_ms_per_cycle', 'stages'}
+
+    def test_pcic(self):
+        with O2D22xEmulator() as emulator:
+            report = bench_pcic(*emulator.address, cycles=5, warmup=1)
+            alloc = bench_alloc(*emulator.address, cycles=3, warmup=1)
+        self.assertLessEqual(self.report_keys | {'failed'}, set(report))
+        self.assertEqual((report['cycles'], report['failed']), (5, 0))
+        self.assertEqual(set(report['stages']), {'network', 'parse', 'decode', 'annotate'})
+        self.assertGreater(report['bytes_per_cycle'], len(synthetic_image()))
+        self.assertEqual(set(alloc), {'pooled', 'cycles', 'allocated_bytes_per_cycle', 'max_allocated_bytes',
+                                      'retained_bytes_per_cycle'})
+
+    def test_rpc(self):
+        timeout = socket.getdefaulttimeout()
+        try:
+            with XmlRpcEmulator() as emulator:
+                report = bench_rpc([emulator.address[0]], emulator.address[1], cycles=3, warmup=1)
+        finally:
+            socket.setdefaulttimeout(timeout)
+        self.assertLessEqual(self.report_keys | {'cameras', 'errors', 'sent_bytes_per_cycle', 'retries'},
+                             set(report))
+        self.assertEqual((report['cameras'], report['cycles'], report['errors']), (1, 3, 0))
+        self.assertEqual(set(report['stages']), {'network', 'parse'})
+        self.assertGreater(report['bytes_per_cycle'], 0)
+
+
+class TestMetadataCache(unittest.TestCase):
+    @staticmethod
+    def start_async(path, port):
+        async def run():
+            proxy = AsyncXmlRpcCameraProxy('127.0.0.1', port, cache=MetadataCache(path))
+            await proxy.connect("3.5.0061")
+            await proxy.get_compaitble_versions()
+            await proxy.init_config()
+            await proxy.disconnect()
+            proxy.cache.save()
+            return proxy.cache, proxy.mac
+
+        return asyncio.run(run())
+
+    @staticmethod
+    def start_sync(path, port):
+        timeout = socket.getdefaulttimeout()
+        proxy = XmlRpcCameraProxy('127.0.0.1', port, timeout=5, cache=MetadataCache(path))
+        try:
+            proxy.connect("3.5.0061")
+            proxy.get_compaitble_versions()
+            proxy.init_config()
+            proxy.cache.save()
+            return proxy.cache, proxy.mac
+        finally:
+            # __del__ disconnects, the emulator must still be running
+            del proxy
+            socket.setdefaulttimeout(timeout)
+
+    def check_calls(self, start):
+        reads = {'xmlConnect', 'xmlGetNetworkParameters', 'xmlGetCompatibleCPVersions', 'xmlGetConfigList'}
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'cache.json')
+            # The port is part of the network parameters, keep it
+            with XmlRpcEmulator() as emulator:
+                port = emulator.address[1]
+            calls = {}
+            for run, mac in (('cold', '00:02:01:00:00:01'), ('warm', '00:02:01:00:00:01'),
+                             ('swapped', '00:02:01:00:00:02')):
+                with XmlRpcEmulator('127.0.0.1', port, mac=mac) as emulator:
+                    cache, device_mac = start(path, port)
+                calls[run] = emulator.calls
+                self.assertEqual(device_mac, mac)
+                self.assertEqual(cache.route('127.0.0.1'), '127.0.0.1')
+                self.assertEqual((cache.hits, cache.misses), (1, 0) if run == 'warm' else (0, 1))
+        self.assertEqual(set(calls['cold']) & reads, reads)
+        # One validation read on top of the session and the configuration state changes
+        self.assertEqual(set(calls['warm']) & reads, {'xmlConnect', 'xmlGetNetworkParameters'})
+        self.assertEqual(set(calls['swapped']) & reads, reads)
+        for run in calls.values():
+            self.assertEqual((run['xmlConnect'], run['xmlOpenConfiguration'], run['xmlTestConfig']), (1, 1, 2))
+
+    def test_async_calls(self):
+        self.check_calls(self.start_async)
+
+    def test_sync_calls(self):
+        self.check_calls(self.start_sync)
 
 
 if __name__ == '__main__':